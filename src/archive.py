@@ -0,0 +1,478 @@
+'''
+On-disk formats for retrieved groups: the message stores (one file per message,
+per-topic mbox files or compressed segment files) and the manifest indexing them.
+
+@author: henryk
+'''
+import os
+import errno
+import tempfile
+import threading
+import hashlib
+import time
+import re
+import zlib
+import struct
+import binascii
+import fcntl
+
+def _new_file_mode():
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0666 & ~umask
+
+NEW_FILE_MODE = _new_file_mode()
+
+def _makedirs(dir_name):
+    try:
+        os.makedirs(dir_name)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def atomic_write(file_name, data):
+    '''Write data to file_name via a temporary file and rename, so that file_name is
+    either complete or not there at all. Creates the directory if necessary.'''
+    dir_name = os.path.dirname(file_name) or "."
+    _makedirs(dir_name)
+    # Temporary files start with a dot, so that read_tree ignores leftovers of an interrupted run
+    fd, temp_name = tempfile.mkstemp(prefix=".%s." % os.path.basename(file_name), dir=dir_name)
+    try:
+        # mkstemp creates files only readable by the owner, use the usual permissions
+        os.fchmod(fd, NEW_FILE_MODE)
+        with os.fdopen(fd, "w") as fp:
+            fp.write(data)
+        os.rename(temp_name, file_name)
+    except:
+        os.unlink(temp_name)
+        raise
+
+def iter_complete_lines(file_name, truncate=True):
+    '''Yield the lines of an append-only file, without line ends. An incomplete last line,
+    left by a process that was killed while writing it, is removed from the file. Without
+    truncate it is only left out, because other processes may be appending to the file.'''
+    if not os.path.exists(file_name):
+        return
+    with open(file_name, "r+" if truncate else "r") as fp:
+        complete = 0
+        for line in fp:
+            if not line.endswith("\n"):
+                if truncate:
+                    fp.truncate(complete)
+                return
+            complete += len(line)
+            yield line[:-1]
+
+def append_to(fp, data, shared=False):
+    '''Append data to the append-only file fp and flush it. If shared, processes on
+    other hosts may be appending to the file as well, over a network file system where
+    O_APPEND doesn't keep their writes apart: data is written under an exclusive lock.'''
+    if not shared:
+        fp.write(data)
+        fp.flush()
+        return
+    fcntl.lockf(fp, fcntl.LOCK_EX)
+    try:
+        fp.seek(0, os.SEEK_END)
+        fp.write(data)
+        fp.flush()
+    finally:
+        fcntl.lockf(fp, fcntl.LOCK_UN)
+
+def read_complete_lines(file_name, truncate=True):
+    '''The lines of an append-only file, see iter_complete_lines'''
+    return list(iter_complete_lines(file_name, truncate))
+
+HEAD_CHUNK = 4096
+CHUNK_SIZE = 1024*1024
+REPEATED_HEADER = "X-Google-Groups"
+
+def _header_end(head, start=0):
+    '''Position after the first empty line in head from start on, or -1'''
+    ends = [ i + len(s) for s in ("\n\n", "\n\r\n") for i in [head.find(s, start)] if i >= 0 ]
+    return min(ends) if ends else -1
+
+def _read_head(fp, length=None, decompressor=None):
+    '''The header of the message at the current position of fp, up to and including the
+    empty line after it, reading at most length bytes and only as much as needed. If the
+    header is repeated by a second one (see demangle.parse_headers), both are returned.'''
+    head = ""
+    start = 0
+    while True:
+        data = fp.read(HEAD_CHUNK if length is None else min(HEAD_CHUNK, length)) if length != 0 else ""
+        if length is not None:
+            length -= len(data)
+        head += decompressor.decompress(data) if decompressor is not None else data
+        end = _header_end(head, start)
+        # Enough data to see whether a second header follows
+        if start == 0 and end >= 0 and (len(head) >= end + len(REPEATED_HEADER) or not data):
+            if not head.startswith(REPEATED_HEADER, end):
+                return head[:end]
+            start = end
+            end = _header_end(head, start)
+        if start > 0 and end >= 0:
+            return head[:end]
+        if not data:
+            return head
+
+class TreeStore(object):
+    '''One file per message, in group/topic/message. Like the other stores it takes the
+    message as a string or as a mapped file (mmap), which isn't copied into memory.
+
+    With blob_dir, the content of each message is stored once in blob_dir, named by its
+    SHA-1, and group/topic/message is a hardlink to it. Messages with the same content,
+    e.g. cross-posted to several groups sharing blob_dir, take up space only once, and
+    aren't written again.'''
+    name = "tree"
+
+    def __init__(self, group_dir, blob_dir=None):
+        self.group_dir = group_dir
+        self.blob_dir = blob_dir
+
+    def write(self, topic, message, data):
+        '''Store a message, returns its location for the manifest'''
+        file_name = os.path.join(self.group_dir, topic, message)
+        if self.blob_dir is None:
+            atomic_write(file_name, data)
+            return None
+
+        digest = hashlib.sha1(data).hexdigest()
+        blob = os.path.join(self.blob_dir, digest[:2], digest[2:])
+        if not os.path.exists(blob):
+            atomic_write(blob, data)
+        _makedirs(os.path.dirname(file_name))
+        try:
+            if os.path.lexists(file_name):
+                os.unlink(file_name)
+            os.link(blob, file_name)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            # Hardlinks not possible here, store a copy
+            atomic_write(file_name, data)
+        return None
+
+    def read(self, topic, message, location=None):
+        with open(os.path.join(self.group_dir, topic, message), "r") as fp:
+            return fp.read()
+
+    def read_head(self, topic, message, location=None):
+        '''Only the header of a message'''
+        with open(os.path.join(self.group_dir, topic, message), "r") as fp:
+            return _read_head(fp)
+
+    def describe(self, topic, message, location=None):
+        return os.path.join(self.group_dir, topic, message)
+
+    def scan(self):
+        '''Yields (topic, message, data, modification time, location) for all stored messages'''
+        if not os.path.isdir(self.group_dir):
+            return
+        for topic in sorted(os.listdir(self.group_dir)):
+            if topic.startswith("."):
+                continue
+            for message in sorted(os.listdir( os.path.join(self.group_dir, topic) )):
+                if message.startswith("."):
+                    continue
+                file_name = os.path.join(self.group_dir, topic, message)
+                with open(file_name, "r") as fp:
+                    data = fp.read()
+                yield topic, message, data, int(os.path.getmtime(file_name)), None
+
+class MboxStore(object):
+    '''One mbox file per topic, in group/topic.mbox. Lines starting with (any number
+    of '>' and) 'From ' are escaped as in mboxrd. The separator line names topic and
+    message, the manifest has offset and length of each message.'''
+    name = "mbox"
+    SUFFIX = ".mbox"
+
+    _escape = re.compile(r"^(>*From )", re.M)
+    _unescape = re.compile(r"^>(>*From )", re.M)
+
+    def __init__(self, group_dir):
+        self.group_dir = group_dir
+        self.lock = threading.Lock()
+
+    def _file_name(self, topic):
+        return os.path.join(self.group_dir, topic + self.SUFFIX)
+
+    def write(self, topic, message, data):
+        with self.lock:
+            _makedirs(self.group_dir)
+            with open(self._file_name(topic), "ab") as fp:
+                fp.seek(0, os.SEEK_END)
+                fp.write("From %s/%s@gggd %s\n" % (topic, message, time.asctime(time.gmtime())))
+                offset = fp.tell()
+                # Escaped in pieces of whole lines
+                pos = 0
+                while pos < len(data):
+                    end = data.find("\n", pos + CHUNK_SIZE)
+                    end = len(data) if end < 0 else end + 1
+                    fp.write(self._escape.sub(r">\1", data[pos:end]))
+                    pos = end
+                length = fp.tell() - offset
+                fp.write("\n")
+        return "%i:%i" % (offset, length)
+
+    def read(self, topic, message, location):
+        offset, length = [int(x) for x in location.split(":")]
+        with open(self._file_name(topic), "rb") as fp:
+            fp.seek(offset)
+            return self._unescape.sub(r"\1", fp.read(length))
+
+    def read_head(self, topic, message, location):
+        offset, length = [int(x) for x in location.split(":")]
+        with open(self._file_name(topic), "rb") as fp:
+            fp.seek(offset)
+            return self._unescape.sub(r"\1", _read_head(fp, length))
+
+    def describe(self, topic, message, location):
+        return "%s@%s" % (self._file_name(topic), location.split(":")[0])
+
+    def scan(self):
+        if not os.path.isdir(self.group_dir):
+            return
+        for name in sorted(os.listdir(self.group_dir)):
+            if not name.endswith(self.SUFFIX) or name.startswith("."):
+                continue
+            topic = name[:-len(self.SUFFIX)]
+            file_name = os.path.join(self.group_dir, name)
+            mtime = int(os.path.getmtime(file_name))
+            with open(file_name, "rb") as fp:
+                content = fp.read()
+            # Escaping guarantees that only separators start with 'From '
+            separators = [m for m in re.finditer(r"^From (\S+)@gggd [^\n]*\n", content, re.M)]
+            for n, m in enumerate(separators):
+                message = m.group(1).split("/")[-1]
+                offset = m.end()
+                end = separators[n+1].start() if n+1 < len(separators) else len(content)
+                # Each message is followed by an empty line, an incomplete last one isn't used
+                if content[end-1:end] != "\n":
+                    continue
+                length = end - 1 - offset
+                yield topic, message, self._unescape.sub(r"\1", content[offset:offset+length]), mtime, "%i:%i" % (offset, length)
+
+class SegmentStore(object):
+    '''Messages compressed into segment files of limited size, group/segment-NNNNNN.gz.
+    Each message is a gzip member of its own, named topic/message, so that a segment
+    is a valid gzip file and each message can be read with one seek.'''
+    name = "segments"
+    PREFIX = "segment-"
+    SUFFIX = ".gz"
+    SEGMENT_SIZE = 64*1024*1024
+
+    def __init__(self, group_dir, segment_size=None):
+        self.group_dir = group_dir
+        self.segment_size = segment_size or self.SEGMENT_SIZE
+        self.lock = threading.Lock()
+        self.current = None
+
+    def _segments(self):
+        if not os.path.isdir(self.group_dir):
+            return []
+        return sorted(n for n in os.listdir(self.group_dir) if n.startswith(self.PREFIX) and n.endswith(self.SUFFIX))
+
+    def _next_segment(self):
+        segments = self._segments()
+        number = int(segments[-1][len(self.PREFIX):-len(self.SUFFIX)]) if segments else 0
+        if segments and os.path.getsize(os.path.join(self.group_dir, segments[-1])) < self.segment_size:
+            return segments[-1]
+        return "%s%06i%s" % (self.PREFIX, number + 1, self.SUFFIX)
+
+    @staticmethod
+    def _member(name, data):
+        '''The pieces of a gzip member with file name name (GzipFile would only keep its
+        basename), compressed CHUNK_SIZE bytes of data at a time'''
+        # Magic, deflate, FNAME flag, mtime, maximum compression, unix
+        yield struct.pack("<BBBBIBB", 0x1f, 0x8b, 8, 0x08, int(time.time()), 2, 3)
+        yield name + "\0"
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        crc = 0
+        for pos in xrange(0, len(data), CHUNK_SIZE):
+            chunk = data[pos:pos+CHUNK_SIZE]
+            crc = zlib.crc32(chunk, crc)
+            yield compressor.compress(chunk)
+        yield compressor.flush()
+        yield struct.pack("<II", crc & 0xffffffff, len(data) & 0xffffffff)
+
+    def write(self, topic, message, data):
+        # Compressed before taking the lock, large messages are spooled to disk
+        with tempfile.SpooledTemporaryFile(max_size=CHUNK_SIZE) as member:
+            for piece in self._member("%s/%s" % (topic, message), data):
+                member.write(piece)
+            length = member.tell()
+            member.seek(0)
+            with self.lock:
+                if self.current is None or os.path.getsize(os.path.join(self.group_dir, self.current)) >= self.segment_size:
+                    _makedirs(self.group_dir)
+                    self.current = self._next_segment()
+                segment = self.current
+                with open(os.path.join(self.group_dir, segment), "ab") as fp:
+                    fp.seek(0, os.SEEK_END)
+                    offset = fp.tell()
+                    for chunk in iter(lambda: member.read(CHUNK_SIZE), ""):
+                        fp.write(chunk)
+        return "%s:%i:%i" % (segment, offset, length)
+
+    def read(self, topic, message, location):
+        segment, offset, length = location.split(":")
+        with open(os.path.join(self.group_dir, segment), "rb") as fp:
+            fp.seek(int(offset))
+            return zlib.decompress(fp.read(int(length)), 16 + zlib.MAX_WBITS)
+
+    def read_head(self, topic, message, location):
+        segment, offset, length = location.split(":")
+        with open(os.path.join(self.group_dir, segment), "rb") as fp:
+            fp.seek(int(offset))
+            return _read_head(fp, int(length), zlib.decompressobj(16 + zlib.MAX_WBITS))
+
+    def describe(self, topic, message, location):
+        return "%s@%s" % (os.path.join(self.group_dir, location.split(":")[0]), location.split(":")[1])
+
+    def scan(self):
+        for segment in self._segments():
+            file_name = os.path.join(self.group_dir, segment)
+            mtime = int(os.path.getmtime(file_name))
+            with open(file_name, "rb") as fp:
+                content = fp.read()
+            offset = 0
+            while offset < len(content):
+                # The member name follows the 10 byte gzip header, zero-terminated
+                name_end = content.find("\0", offset + 10)
+                name = content[offset+10:name_end]
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                try:
+                    data = decompressor.decompress(content[offset:])
+                    if not decompressor.unused_data:
+                        # Last member, make sure it's complete and not cut off by an interrupted write
+                        zlib.decompress(content[offset:], 16 + zlib.MAX_WBITS)
+                except zlib.error:
+                    # Cut off by an interrupted write, continue with the next member if there is one
+                    offset = content.find("\x1f\x8b\x08", offset + 1)
+                    if offset < 0:
+                        break
+                    continue
+                length = len(content) - offset - len(decompressor.unused_data)
+                topic, message = name.split("/")[-2:]
+                yield topic, message, data, mtime, "%s:%i:%i" % (segment, offset, length)
+                offset = offset + length
+
+STORES = dict( (s.name, s) for s in (TreeStore, MboxStore, SegmentStore) )
+
+def detect_format(group_dir):
+    '''Guess the store format of an existing group directory, "tree" if there is none'''
+    if os.path.isdir(group_dir):
+        for name in os.listdir(group_dir):
+            if name.endswith(MboxStore.SUFFIX):
+                return MboxStore.name
+            if name.startswith(SegmentStore.PREFIX) and name.endswith(SegmentStore.SUFFIX):
+                return SegmentStore.name
+    return TreeStore.name
+
+class ArchiveManifest(object):
+    '''Index of the messages in a group directory, with size, SHA-1, time of retrieval
+    and, for packed formats, the location in the store.
+
+    Kept next to the group directory as an append-only file with one line per message,
+    so that update mode doesn't need to scan the directory tree. If shared, other
+    processes are appending to the file as well.
+
+    Entries are (size, sha1, fetch time, location) tuples. In memory each one is packed
+    into a single string, because groups can have millions of messages.'''
+    _ENTRY = struct.Struct("<II20s")
+
+    def __init__(self, file_name, shared=False):
+        self.file_name = file_name
+        self.shared = shared
+        self.topics = {}   # topic -> message -> packed entry, see get
+        self.lock = threading.Lock()
+        self.fp = None
+        self.load()
+
+    @classmethod
+    def _pack(cls, entry):
+        size, sha1, fetch_time, location = entry
+        return cls._ENTRY.pack(size, fetch_time, binascii.unhexlify(sha1)) + (location or "")
+
+    @classmethod
+    def _unpack(cls, packed):
+        size, fetch_time, sha1 = cls._ENTRY.unpack_from(packed)
+        return (size, binascii.hexlify(sha1), fetch_time, packed[cls._ENTRY.size:] or None)
+
+    def exists(self):
+        return os.path.exists(self.file_name)
+
+    def load(self):
+        # Replaced in one go, other threads may be looking at it (see GroupInformation.work)
+        topics = {}
+        pack, unhexlify = self._ENTRY.pack, binascii.unhexlify
+        for line in iter_complete_lines(self.file_name, truncate=not self.shared):
+            fields = line.split("\t")
+            if len(fields) in (5, 6) and len(fields[3]) == 40:
+                topic, message, size, checksum, fetch_time = fields[:5]
+                location = fields[5] if len(fields) > 5 else ""
+                try:
+                    topics.setdefault(topic, {})[message] = pack(int(size), int(fetch_time), unhexlify(checksum)) + location
+                except (ValueError, TypeError, struct.error):
+                    # Garbled, the message counts as not retrieved
+                    pass
+        self.topics = topics
+
+    def contains(self, topic, message):
+        return message in self.topics.get(topic, ())
+
+    def get(self, topic, message):
+        '''The entry of a message, or None'''
+        packed = self.topics.get(topic, {}).get(message)
+        return self._unpack(packed) if packed is not None else None
+
+    def entries(self):
+        '''All (topic, message, entry)'''
+        for topic, messages in self.topics.items():
+            for message, packed in messages.items():
+                yield topic, message, self._unpack(packed)
+
+    @staticmethod
+    def _line(topic, message, entry):
+        return "\t".join([topic, message] + [str(e) for e in entry[:3]] + [entry[3] or ""]) + "\n"
+
+    def add(self, topic, message, data, fetch_time=None, location=None):
+        entry = (len(data), hashlib.sha1(data).hexdigest(), int(fetch_time or time.time()), location)
+        with self.lock:
+            self.topics.setdefault(topic, {})[message] = self._pack(entry)
+            if self.fp is None:
+                self.fp = open(self.file_name, "a")
+            append_to(self.fp, self._line(topic, message, entry), self.shared)
+
+    def remove(self, messages):
+        '''Drop the entries of the (topic, message) pairs in messages, rewriting the file'''
+        with self.lock:
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+            for topic, message in messages:
+                self.topics.get(topic, {}).pop(message, None)
+            fd, temp_name = tempfile.mkstemp(prefix=".%s." % os.path.basename(self.file_name), dir=os.path.dirname(self.file_name) or ".")
+            os.fchmod(fd, NEW_FILE_MODE)
+            with os.fdopen(fd, "w") as fp:
+                for topic, entries in self.topics.iteritems():
+                    for message, packed in entries.iteritems():
+                        fp.write(self._line(topic, message, self._unpack(packed)))
+            os.rename(temp_name, self.file_name)
+
+    def rebuild(self, store):
+        '''Regenerate the manifest from the messages in store, returns the number of topics'''
+        with self.lock:
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+            self.topics = {}
+            fd, temp_name = tempfile.mkstemp(prefix=".%s." % os.path.basename(self.file_name), dir=os.path.dirname(self.file_name) or ".")
+            os.fchmod(fd, NEW_FILE_MODE)
+            with os.fdopen(fd, "w") as fp:
+                for topic, message, data, mtime, location in store.scan():
+                    entry = (len(data), hashlib.sha1(data).hexdigest(), mtime, location)
+                    self.topics.setdefault(topic, {})[message] = self._pack(entry)
+                    fp.write(self._line(topic, message, entry))
+            os.rename(temp_name, self.file_name)
+            return len(self.topics)
@@ -0,0 +1,274 @@
+#!/usr/bin/env python2.7
+'''
+bench -- Measure gggd against a local stand-in for Google Groups
+
+Starts a HTTP server with a synthetic group (topic pages, topic listings, raw
+messages, some of them mangled like Google does, and the RSS feed), runs gggd
+against it and reports requests and messages per second, peak memory use and
+the time of each phase.
+
+@author: henryk
+'''
+from argparse import ArgumentParser
+import sys
+import os
+import time
+import random
+import json
+import shutil
+import tempfile
+import subprocess
+import multiprocessing
+import hashlib
+import zlib
+import BaseHTTPServer
+import SocketServer
+import urlparse
+
+from demangle import handle_data, ProcessingError
+from archive import ArchiveManifest, STORES, detect_format
+
+GROUP = "bench"
+TOPICS_PER_PAGE = 20
+
+class SyntheticGroup(object):
+    '''Contents of the synthetic group. Topic 0 is the most recently active one.'''
+    def __init__(self, base_url, topics, messages, size, mangled):
+        self.base_url = base_url
+        self.topics = topics
+        self.messages = messages
+        self.size = size
+        self.mangled = mangled
+
+    def topic_id(self, n):
+        return "t%06d" % n
+
+    def message_id(self, n):
+        return "m%04d" % n
+
+    def topic_page(self, start):
+        rows = []
+        for n in range(start, min(start + TOPICS_PER_PAGE, self.topics)):
+            rows.append('<tr><td><a href="%s/d/topic/%s/%s" title="Topic %i">Topic %i</a></td>'
+                '<td class="lastPostDate">%s</td></tr>' % (self.base_url, GROUP, self.topic_id(n), n, n,
+                time.strftime("%m/%d/%y", time.gmtime(self.date(n, 0)))))
+        more = ""
+        if start + TOPICS_PER_PAGE < self.topics:
+            more = '<a href="%s/forum/?_escaped_fragment_=forum/%s[%i-%i-false]">More topics</a>' % (
+                self.base_url, GROUP, start + TOPICS_PER_PAGE + 1, start + 2*TOPICS_PER_PAGE)
+        return "<html><head><title>%s</title></head><body><table>%s</table>%s</body></html>" % (GROUP, "".join(rows), more)
+
+    def topic_listing(self, topic):
+        return "<html><body>%s</body></html>" % "".join( '<div class="message"><a href="%s/d/msg/%s/%s/%s">Message %i</a></div>'
+            % (self.base_url, GROUP, topic, self.message_id(n), n) for n in range(self.messages) )
+
+    def date(self, topic, message):
+        return 1400000000 - topic*3600 + message*60
+
+    def message(self, topic, message):
+        '''The raw message, mangled like Google does for a share of self.mangled of
+        all messages: with a repeated header, or with a nested MIME part header missing'''
+        rng = random.Random("%s/%s" % (topic, message))
+        header = ("From: User %i <user%i@example.com>\r\nDate: %s\r\nMessage-ID: <%s.%s@example.com>\r\nSubject: Topic %s\r\n"
+            % (rng.randint(0, 99), rng.randint(0, 99), time.strftime("%a, %d %b %Y %H:%M:%S +0000",
+            time.gmtime(self.date(int(topic[1:]), int(message[1:])))), topic, message, topic))
+        words = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit"]
+        body = []
+        length = 0
+        while length < self.size:
+            line = " ".join(rng.choice(words) for _ in range(10)) + "\r\n"
+            # Paragraphs of up to five lines
+            if len(body) % 5 == 4:
+                line += "\r\n"
+            body.append(line)
+            length += len(line)
+        body = "".join(body)
+
+        kind = rng.random()
+        if kind < self.mangled / 2:
+            return ("From: User <user@example.com>\r\nSubject: Topic %s\r\n\r\nX-Google-Groups: %s\r\nX-Google-Thread: %s\r\n%s\r\n%s"
+                % (topic, GROUP, topic, header, body))
+        elif kind < self.mangled:
+            return ('%sMIME-Version: 1.0\r\nContent-Type: multipart/mixed; boundary="outer"\r\n\r\n--outer\r\n--inner\r\n'
+                'Content-Type: text/plain\r\n\r\n%s\r\n--inner--\r\n--outer--\r\n' % (header, body))
+        return "%s\r\n%s" % (header, body)
+
+    def feed(self, count):
+        items = []
+        for t in range(self.topics):
+            for m in range(self.messages - 1, -1, -1):
+                if len(items) >= count:
+                    break
+                items.append("<item><title>Topic %i</title><link>%s/d/msg/%s/%s/%s</link></item>"
+                    % (t, self.base_url, GROUP, self.topic_id(t), self.message_id(m)))
+        return '<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel><title>%s</title>%s</channel></rss>' % (GROUP, "".join(items))
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, code, body, content_type="text/html; charset=UTF-8"):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        # Compressed for clients that ask for it, like Google does
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        with server.requests.get_lock():
+            server.requests.value += 1
+        if server.latency:
+            time.sleep(server.latency)
+        if server.error_rate and random.random() < server.error_rate:
+            return self.send(503, "<html>Service Unavailable</html>")
+
+        group = server.group
+        path, _, query = self.path.partition("?")
+        query = urlparse.parse_qs(query)
+        if "_escaped_fragment_" in query:
+            fragment = query["_escaped_fragment_"][0]
+            if fragment.startswith("forum/"):
+                start = 0
+                if "[" in fragment:
+                    start = int(fragment.split("[")[1].split("-")[0]) - 1
+                return self.send(200, group.topic_page(start))
+            if fragment.startswith("topic/"):
+                return self.send(200, group.topic_listing(fragment.split("/")[2]))
+        if path.endswith("/forum/message/raw") and "msg" in query:
+            _, topic, message = query["msg"][0].split("/")
+            return self.send(200, group.message(topic, message), "text/plain; charset=UTF-8")
+        if path.endswith("/msgs/rss.xml"):
+            return self.send(200, group.feed(int(query.get("num", ["50"])[0])), "application/rss+xml")
+        self.send(404, "<html>Not found</html>")
+
+def _serve(ready, requests, topics, messages, size, mangled, latency, error_rate):
+    server = _Server(("127.0.0.1", 0), _Handler)
+    base_url = "http://127.0.0.1:%i" % server.server_address[1]
+    server.group = SyntheticGroup(base_url, topics, messages, size, mangled)
+    server.requests = requests
+    server.latency = latency
+    server.error_rate = error_rate
+    ready.put(base_url)
+    server.serve_forever()
+
+def start_server(topics, messages, size, mangled=0.2, latency=0, error_rate=0):
+    '''Run the server in a process of its own, returns (process, base URL, request counter)'''
+    ready = multiprocessing.Queue()
+    requests = multiprocessing.Value("l", 0)
+    process = multiprocessing.Process(target=_serve, args=(ready, requests, topics, messages, size, mangled, latency, error_rate))
+    process.daemon = True
+    process.start()
+    return process, ready.get(), requests
+
+GGGD = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gggd.py")
+
+def run_gggd(args, cwd):
+    '''Run gggd in a process of its own, returns (seconds, peak resident memory in kB)'''
+    started = time.time()
+    with open(os.devnull, "w") as devnull:
+        p = subprocess.Popen([sys.executable, GGGD] + args, cwd=cwd, stdout=devnull)
+        _, status, usage = os.wait4(p.pid, 0)
+    if status != 0:
+        print >>sys.stderr, "gggd %s: exit status %i" % (" ".join(args), status >> 8)
+    return time.time() - started, usage.ru_maxrss
+
+def add_made_up_messages(manifest, count):
+    '''Append count messages that don't exist to manifest, 10 per topic'''
+    with open(manifest, "a") as fp:
+        for n in range(count):
+            fp.write("x%07i\tm%04i\t%i\t%s\t%i\t\n" % (n // 10, n % 10, 1000 + n % 50000,
+                hashlib.sha1(str(n)).hexdigest(), 1400000000 + n))
+
+def demangle_all(directory):
+    '''Demangle all retrieved messages in memory, returns (messages, changed, bytes, seconds)'''
+    group_dir = os.path.join(directory, GROUP)
+    store = STORES[detect_format(group_dir)](group_dir)
+    manifest = ArchiveManifest(os.path.join(directory, "%s.manifest" % GROUP))
+    contents = [ store.read(topic, message, entry[3]) for topic, message, entry in manifest.entries() ]
+    changed = 0
+    started = time.time()
+    for data in contents:
+        ops = []
+        try:
+            handle_data(data, ops)
+        except ProcessingError:
+            pass
+        if ops:
+            changed += 1
+    return len(contents), changed, sum(len(d) for d in contents), time.time() - started
+
+def main(argv=None):
+    parser = ArgumentParser(description="Measure gggd against a local stand-in for Google Groups")
+    parser.add_argument("-t", "--topics", help="Number of topics [default: %(default)s]", default=200, type=int)
+    parser.add_argument("-m", "--messages", help="Number of messages per topic [default: %(default)s]", default=5, type=int)
+    parser.add_argument("-s", "--size", help="Approximate size of message bodies, in bytes [default: %(default)s]", default=4000, type=int)
+    parser.add_argument("--mangled", help="Share of mangled messages [default: %(default)s]", default=0.2, type=float)
+    parser.add_argument("--latency", help="Delay of each response, in seconds [default: %(default)s]", default=0, type=float)
+    parser.add_argument("--error-rate", help="Share of requests answered with HTTP 503 [default: %(default)s]", default=0, type=float)
+    parser.add_argument("-j", "--jobs", help="-j for gggd [default: %(default)s]", default=4, type=int)
+    parser.add_argument("-f", "--format", choices=sorted(STORES.keys()), default="tree", help="--format for gggd [default: %(default)s]")
+    parser.add_argument("--large", metavar="N", type=int, default=0, help="Also measure an update with N more (made up) messages in the manifest, as for a large group")
+    parser.add_argument("--keep", metavar="DIR", help="Retrieve into DIR (which must not exist) and keep it, instead of a temporary directory")
+    parser.add_argument("--json", metavar="FILE", help="Also write the results to FILE, as JSON")
+    args = parser.parse_args(argv)
+
+    process, base_url, requests = start_server(args.topics, args.messages, args.size, args.mangled, args.latency, args.error_rate)
+    directory = args.keep or tempfile.mkdtemp(prefix="gggd-bench-")
+    if args.keep:
+        os.makedirs(directory)
+    options = ["--base-url", base_url, "-c", "", "-b", "-j", str(args.jobs)]
+    total = args.topics * args.messages
+
+    results = []
+    def measure(phase, gggd_args, messages):
+        before = requests.value
+        seconds, memory = run_gggd(gggd_args, directory)
+        count = requests.value - before
+        results.append(dict(phase=phase, seconds=seconds, requests=count, messages=messages, peak_rss_kb=memory))
+
+    try:
+        measure("crawl", options + ["-f", args.format, GROUP], total)
+        measure("recrawl", options + [GROUP], 0)
+        measure("update", options + ["-u", GROUP], 0)
+        if args.large:
+            manifest = os.path.join(directory, "%s.manifest" % GROUP)
+            shutil.copy(manifest, manifest + ".orig")
+            add_made_up_messages(manifest, args.large)
+            measure("update-large", options + ["-u", GROUP], total + args.large)
+            os.rename(manifest + ".orig", manifest)
+        measure("rebuild-index", ["--rebuild-index", GROUP], total)
+        measure("index", ["index", GROUP], total)
+        count, changed, size, seconds = demangle_all(directory)
+        results.append(dict(phase="demangle", seconds=seconds, requests=0, messages=count, changed=changed, bytes=size, peak_rss_kb=None))
+    finally:
+        process.terminate()
+        if not args.keep:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    print "%i topics with %i messages of %i bytes, %i%% mangled, %.3fs latency, %i%% errors, -j %i, %s format" % (args.topics,
+        args.messages, args.size, args.mangled*100, args.latency, args.error_rate*100, args.jobs, args.format)
+    print "%-14s %9s %9s %9s %9s %9s %10s" % ("phase", "seconds", "requests", "req/s", "messages", "msg/s", "peak RSS")
+    for r in results:
+        seconds = max(r["seconds"], 1e-6)
+        print "%-14s %9.2f %9i %9.1f %9i %9.1f %10s" % (r["phase"], r["seconds"], r["requests"], r["requests"] / seconds,
+            r["messages"], r["messages"] / seconds, "%.1f MB" % (r["peak_rss_kb"] / 1024.0) if r["peak_rss_kb"] else "-")
+
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump(dict(settings=vars(args), results=results), fp, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,120 @@
+#!/usr/bin/env python2.7
+'''
+check_links -- Compare the link extractor of gggd with the HTMLParser based lister
+
+Feeds saved topic pages and topic listings to gggd.LinkExtractor, in pieces of
+several sizes as they would arrive from the server, and compares the links and
+last post dates with those of the HTMLParser based lister gggd used before, which
+lists the links like lynx -listonly. Also reports the time each needs per page.
+
+The pages in src/fixtures are checked by default. Other saved pages (e.g. with
+curl 'https://groups.google.com/forum/?_escaped_fragment_=forum/GROUP') can be
+given on the command line, with the URL they were retrieved from.
+
+@author: henryk
+'''
+from argparse import ArgumentParser
+import sys
+import os
+import time
+import urlparse
+from HTMLParser import HTMLParser
+
+from gggd import LinkExtractor, HTTPFetcher
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+BASE_URL = "https://groups.google.com/forum/?_escaped_fragment_=forum/example-group"
+# As received from the server, and whole
+CHUNK_SIZES = (1, 7, 100, HTTPFetcher.CHUNK_SIZE, None)
+
+class ReferenceLister(HTMLParser):
+    '''The HTMLParser based lister: all link targets of a HTML page, and the last post
+    date shown next to each topic link, in last_posts, keyed by link target.'''
+    def __init__(self, base_url):
+        HTMLParser.__init__(self)
+        self.base_url = base_url
+        self.links = []
+        self.last_posts = {}
+        self.date_tag = None
+        self.date_text = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "a":
+            for k, v in attrs:
+                if k == "href" and v:
+                    self.links.append( urlparse.urljoin(self.base_url, v) )
+        for k, v in attrs:
+            if k == "class" and v and "lastPostDate" in v.split():
+                self.date_tag = tag
+                self.date_text = []
+
+    def handle_endtag(self, tag):
+        if tag == self.date_tag:
+            self.date_tag = None
+            if self.links:
+                self.last_posts[self.links[-1]] = " ".join("".join(self.date_text).split())
+
+    def handle_data(self, data):
+        if self.date_tag:
+            self.date_text.append(data)
+
+def reference(data, base_url):
+    '''(links, last_posts) of the page data, with the reference lister'''
+    lister = ReferenceLister(base_url)
+    lister.feed(data.decode("utf-8", "replace"))
+    lister.close()
+    return ([l.encode("utf-8") for l in lister.links],
+        dict( (l.encode("utf-8"), d.encode("utf-8")) for l, d in lister.last_posts.iteritems() ))
+
+def extract(data, base_url, chunk_size=None):
+    '''(links, last_posts) of the page data, with LinkExtractor fed pieces of chunk_size'''
+    extractor = LinkExtractor(base_url)
+    chunk_size = chunk_size or len(data) or 1
+    for start in range(0, len(data), chunk_size):
+        extractor.feed(data[start:start+chunk_size])
+    extractor.close()
+    return extractor.links, extractor.last_posts
+
+def _time(function, *args):
+    '''Seconds per call of function(*args)'''
+    count, start = 0, time.time()
+    while count < 3 or time.time() - start < 0.2:
+        function(*args)
+        count += 1
+    return (time.time() - start) / count
+
+def check(file_name, base_url):
+    '''Compare both on one page, returns the number of differences'''
+    with open(file_name, "rb") as fp:
+        data = fp.read()
+    expected = reference(data, base_url)
+    differences = 0
+    for chunk_size in CHUNK_SIZES:
+        links, last_posts = extract(data, base_url, chunk_size)
+        if links != expected[0]:
+            print "%s, pieces of %s: links differ" % (file_name, chunk_size or "all")
+            for l in sorted(set(links) ^ set(expected[0])):
+                print "  %s %s" % ("+" if l in links else "-", l)
+            differences += 1
+        if last_posts != expected[1]:
+            print "%s, pieces of %s: last post dates differ" % (file_name, chunk_size or "all")
+            for l in sorted(set(last_posts.items()) ^ set(expected[1].items())):
+                print "  %s %s: %s" % ("+" if l in last_posts.items() else "-", l[0], l[1])
+            differences += 1
+    print "%s: %i links, %i last post dates, %.3fms (HTMLParser %.3fms)%s" % (os.path.basename(file_name),
+        len(expected[0]), len(expected[1]), _time(extract, data, base_url, HTTPFetcher.CHUNK_SIZE) * 1000,
+        _time(reference, data, base_url) * 1000, "" if not differences else ", %i differences" % differences)
+    return differences
+
+def main(argv=None):
+    parser = ArgumentParser(description="Compare the links gggd extracts from saved pages with those of the HTMLParser based lister")
+    parser.add_argument("-u", "--url", default=BASE_URL, help="URL the pages were retrieved from, for relative links [default: %(default)s]")
+    parser.add_argument(dest="files", nargs="*", help="Saved pages [default: the pages in %s]" % FIXTURES, metavar="file")
+    args = parser.parse_args(argv)
+
+    files = args.files or sorted( os.path.join(FIXTURES, f) for f in os.listdir(FIXTURES) if f.endswith(".html") )
+    differences = sum( check(f, args.url) for f in files )
+    return 1 if differences else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,122 +6,323 @@ Created on 3 Nov 2014
 '''
 from argparse import ArgumentParser
 import sys
+import os
 import email.parser
+import multiprocessing
+import json
+import mmap
+import tempfile
+
+from archive import NEW_FILE_MODE
 
 __version__ = 0.1
 
 class ProcessingError(Exception): pass
 
-def process_multiple_headers(data):
-    parts = data.split("\r\n\r\n", 2)
-    if len(parts) < 3:
+CRLF = "\r\n"
+HEADER_END = "\r\n\r\n"
+
+def _at(buf, pos, s):
+    '''buf[pos:].startswith(s), for both strings and mmap objects'''
+    return buf[pos:pos+len(s)] == s
+
+def _multiple_headers_start(buf, start=0):
+    '''Returns where the message in buf, starting at start, really starts: after the
+    first header if the second one is a superset of it, else start.'''
+    first = buf.find(HEADER_END, start)
+    second = buf.find(HEADER_END, first+4) if first >= 0 else -1
+    if second < 0:
         raise ProcessingError("Malformed message")
-    if parts[1].startswith("X-Google-Groups"):
-        if len(parts[1]) > len(parts[0]):
-            data = data[len(parts[0])+4:]
-    return data
+    if _at(buf, first+4, "X-Google-Groups"):
+        if second - (first+4) > first - start:
+            return first+4
+    return start
 
-def fix_nested_mime(data):
-    msg = email.parser.Parser().parsestr(data, headersonly=True)
-    parts = data.split("\r\n")
+def _nested_mime_insertion(buf, start=0):
+    '''Finds a nested MIME part whose header was removed, in the message in buf that
+    starts at start. Returns (offset, header to insert there) or None.
+
+    Only the header and the body up to the first boundary that is followed by another
+    boundary are looked at.'''
+    # The body starts after the first empty line
+    if _at(buf, start, CRLF):
+        body_start = start + 2
+    else:
+        body_start = buf.find(HEADER_END, start)
+        if body_start < 0:
+            return None
+        body_start = body_start + 4
     
+    header = buf[start:body_start]
+    # Cheap prefilter: without a boundary parameter there are no MIME parts to look at
+    if not "boundary" in header.lower():
+        return None
+    msg = email.parser.Parser().parsestr(header, headersonly=True)
     outer_boundary = msg.get_boundary()
+    if outer_boundary is None:
+        return None
     outer_content_type = msg.get_content_type()
     
-    in_body = False
-    last_was_boundary = False
-    insert_at = None
-    inner_boundary = None
-    
-    for n, l in enumerate(parts):
-        if not in_body:
-            if l == "":
-                in_body = True
+    # Look for the first line that is the outer boundary and is followed by a line
+    # starting with "--". This looks like a MIME boundary is following immediately after a
+    # boundary. There is a very high chance that this was a part that had only a header and
+    # for reasons unknown was removed by Google. Insert a new header indicating the
+    # following line as a MIME boundary. We don't know the correct MIME type, but will
+    # apply a heuristic to guess it, based on the outer MIME type.
+    boundary_line = "--%s" % outer_boundary
+    end = len(buf)
+    pos = buf.find(boundary_line, body_start)
+    while pos >= 0:
+        line_end = pos + len(boundary_line)
+        if (pos == body_start or _at(buf, pos-2, CRLF)) and _at(buf, line_end, CRLF):
+            next_line = line_end + 2
+            if _at(buf, next_line, "--"):
+                next_line_end = buf.find(CRLF, next_line)
+                if next_line_end < 0:
+                    next_line_end = end
+                inner_boundary = buf[next_line+2:next_line_end]
+                break
+            # The line after a boundary is never taken as a boundary
+            pos = buf.find(boundary_line, next_line+1)
         else:
-            if not last_was_boundary:
-                if l == "--%s" % outer_boundary:
-                    last_was_boundary = True
-            else:
-                last_was_boundary = False
-                
-                if insert_at is None:
-                    if l.startswith("--"):
-                        # This looks like a MIME boundary is following immediately after a boundary. 
-                        # There is a very high chance that this was a part that had only a header and
-                        # for reasons unknown was removed by Google. Insert a new header indicating the
-                        # current line as a MIME boundary. We don't know the correct MIME type, but will
-                        # apply a heuristic to guess it, based on the outer MIME type.
-                        
-                        insert_at = n
-                        inner_boundary = l[2:]
-                        break
-    
-    if insert_at is not None:
-        guessed_content_type = None
-        if outer_content_type == "multipart/mixed":
-            guessed_content_type = "multipart/alternative"
-        elif outer_content_type == "multipart/related":
-            guessed_content_type = "multipart/alternative"
-        elif outer_content_type == "multipart/alternative":
-            guessed_content_type = "multipart/mixed"
-        elif outer_content_type == "multipart/signed":
-            guessed_content_type = "multipart/mixed"
-        
-        if guessed_content_type is None:
-            raise ProcessingError("Unknown outer MIME content type %s, couldn't guess nested MIME type" % outer_content_type)
-        
-        parts.insert(insert_at, "Content-Type: %s; " % guessed_content_type)
-        parts.insert(insert_at+1, '  boundary="%s"' % inner_boundary)
-        parts.insert(insert_at+2, "")
-        data = "\r\n".join(parts)
+            pos = buf.find(boundary_line, pos+1)
+    else:
+        return None
+    
+    guessed_content_type = None
+    if outer_content_type == "multipart/mixed":
+        guessed_content_type = "multipart/alternative"
+    elif outer_content_type == "multipart/related":
+        guessed_content_type = "multipart/alternative"
+    elif outer_content_type == "multipart/alternative":
+        guessed_content_type = "multipart/mixed"
+    elif outer_content_type == "multipart/signed":
+        guessed_content_type = "multipart/mixed"
     
+    if guessed_content_type is None:
+        raise ProcessingError("Unknown outer MIME content type %s, couldn't guess nested MIME type" % outer_content_type)
+    
+    return next_line, 'Content-Type: %s; \r\n  boundary="%s"\r\n\r\n' % (guessed_content_type, inner_boundary)
+
+def process_multiple_headers(data):
+    return data[_multiple_headers_start(data):]
+
+def fix_nested_mime(data):
+    insertion = _nested_mime_insertion(data)
+    if insertion is not None:
+        offset, text = insertion
+        data = data[:offset] + text + data[offset:]
     return data
 
 OPERATORS = [process_multiple_headers, fix_nested_mime]
 
-def handle_data(data):
-    for op in OPERATORS:
-        try:
-            data = op(data)
-        except ProcessingError as e:
-            e.message = "%s: %s" % (op.__name__, e.message)
-            raise
-    return data
+def parse_headers(buf):
+    '''Parse only the header of the message in buf (a string or mmap object), skipping
+    a first header that is repeated by the second one, as process_multiple_headers does.
+    Returns an email.message.Message without payload.'''
+    try:
+        start = _multiple_headers_start(buf)
+    except ProcessingError:
+        start = 0
+    end = buf.find(HEADER_END, start)
+    if end < 0:
+        # Converted to unix line endings, or no body at all
+        end = buf.find("\n\n", start)
+    if end < 0:
+        end = len(buf)
+    return email.parser.Parser().parsestr(buf[start:end], headersonly=True)
+
+def demangle_pieces(buf, changed=None):
+    '''Applies all operators to buf (a string or mmap object) in one pass, without
+    copying it. Returns the result as a list of pieces: (begin, end) ranges of buf
+    and strings to insert between them. If changed is a list, the names of the
+    operators that modified the data are appended to it.'''
+    try:
+        op = process_multiple_headers
+        start = _multiple_headers_start(buf)
+        op = fix_nested_mime
+        insertion = _nested_mime_insertion(buf, start)
+    except ProcessingError as e:
+        e.message = "%s: %s" % (op.__name__, e.message)
+        e.operator = op.__name__
+        raise
+    
+    if changed is not None:
+        if start > 0:
+            changed.append(process_multiple_headers.__name__)
+        if insertion is not None:
+            changed.append(fix_nested_mime.__name__)
+    
+    if insertion is None:
+        return [(start, len(buf))]
+    offset, text = insertion
+    return [(start, offset), text, (offset, len(buf))]
 
-def handle_file(filename, in_place, suffix, dry_run):
+def join_pieces(buf, pieces):
+    return "".join( p if isinstance(p, str) else buf[p[0]:p[1]] for p in pieces )
+
+def handle_data(data, changed=None):
+    '''Apply all operators to data. If changed is a list, the names of the
+    operators that modified the data are appended to it.'''
+    pieces = demangle_pieces(data, changed)
+    if pieces == [(0, len(data))]:
+        # Unchanged, most messages are
+        return data
+    return join_pieces(data, pieces)
+
+def _count_up_to(buf, s, limit):
+    '''Number of occurrences of s in buf, but stop counting at limit'''
+    count = 0
+    pos = buf.find(s)
+    while pos >= 0 and count < limit:
+        count = count + 1
+        pos = buf.find(s, pos+len(s))
+    return count
+
+def handle_file(filename, in_place, suffix, dry_run, unchanged="link"):
+    '''Demangle one file (or stdin if filename is None).
+
+    unchanged determines what happens with files that need no demangling: "write"
+    writes the output file anyway, "link" hardlinks it to the input file and "skip"
+    doesn't create it. Returns (filename, names of changing operators, name of the
+    failing operator or None).'''
+    input_fp = None
     if not filename is None:
-        data = open(filename, "r").read()
+        input_fp = open(filename, "r")
+        size = os.fstat(input_fp.fileno()).st_size
+        # Files are mapped instead of read, only the demangled parts are copied
+        buf = mmap.mmap(input_fp.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else ""
         stdin = False
     else:
-        data = sys.stdin.read()
+        buf = sys.stdin.read()
         stdin = True
         filename = "<stdin>"
     
-    # Allow to operate on local unix files
-    if len(data.split("\r\n")) < 10 and len(data.split("\n")) > 10:
-        converted_line_endings = True
-        data = "\r\n".join( data.split("\n") )
-    else:
-        converted_line_endings = False
-    
     try:
-        data = handle_data(data)
-    except ProcessingError as e:
-        print >>sys.stderr, "%s: %s" % (filename, e.message)
+        # Allow to operate on local unix files
+        if _count_up_to(buf, "\r\n", 9) < 9 and _count_up_to(buf, "\n", 10) >= 10:
+            converted_line_endings = True
+            buf = buf[:].replace("\n", "\r\n")
+        else:
+            converted_line_endings = False
+        
+        changed = []
+        failed = None
+        try:
+            pieces = demangle_pieces(buf, changed)
+        except ProcessingError as e:
+            print >>sys.stderr, "%s: %s" % (filename, e.message)
+            failed = e.operator
+            pieces = [(0, len(buf))]
+        
+        if converted_line_endings:
+            buf = join_pieces(buf, pieces).replace("\r\n", "\n")
+            pieces = [(0, len(buf))]
+        
+        if not dry_run:
+            if stdin:
+                write_pieces(sys.stdout, buf, pieces)
+            else:
+                if in_place:
+                    out_name = filename
+                else:
+                    out_name = filename + suffix
+                
+                if not changed and (in_place or unchanged == "skip"):
+                    pass
+                elif not changed and unchanged == "link":
+                    if os.path.lexists(out_name):
+                        os.unlink(out_name)
+                    os.link(filename, out_name)
+                else:
+                    # Write next to the output file and rename, the input may still be mapped
+                    fd, temp_name = tempfile.mkstemp(prefix=".%s." % os.path.basename(out_name), dir=os.path.dirname(out_name) or ".")
+                    try:
+                        os.chmod(temp_name, os.stat(filename).st_mode & 07777 if in_place else NEW_FILE_MODE)
+                        with os.fdopen(fd, "w") as fp:
+                            write_pieces(fp, buf, pieces)
+                        os.rename(temp_name, out_name)
+                    except:
+                        os.unlink(temp_name)
+                        raise
+    finally:
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+        if input_fp is not None:
+            input_fp.close()
     
-    if converted_line_endings:
-        data = "\n".join( data.split("\r\n") )
+    return filename, changed, failed
+
+def write_pieces(fp, buf, pieces, chunk_size=1024*1024):
+    for p in pieces:
+        if isinstance(p, str):
+            fp.write(p)
+        else:
+            for pos in xrange(p[0], p[1], chunk_size):
+                fp.write( buf[pos:min(pos+chunk_size, p[1])] )
+
+def _handle_file_job(job):
+    # Runs in a pool worker, exceptions can't be printed by main() there
+    try:
+        return handle_file(*job)
+    except Exception as e:
+        print >>sys.stderr, "%s: %s" % (job[0], e)
+        return job[0], [], "error"
+
+def find_files(names, suffix):
+    '''Expand directories in names to the files in them, leaving out hidden files and
+    earlier output files'''
+    for name in names:
+        if name is None or not os.path.isdir(name):
+            yield name
+            continue
+        for dir_name, dir_names, file_names in os.walk(name):
+            dir_names[:] = sorted(d for d in dir_names if not d.startswith("."))
+            for f in sorted(file_names):
+                if not f.startswith(".") and not (suffix and f.endswith(suffix)):
+                    yield os.path.join(dir_name, f)
+
+class Summary(object):
+    '''Counts changed, unchanged and failed files, overall and per operator. With
+    keep_files, also the names of the files each operator changed or failed on.'''
+    def __init__(self, keep_files=False):
+        self.counts = {"changed": 0, "unchanged": 0, "failed": 0}
+        self.operators = dict( (op.__name__, {"changed": 0, "failed": 0}) for op in OPERATORS )
+        # operator -> "changed" or "failed" -> file names
+        self.files = {} if keep_files else None
     
-    if not dry_run:
-        if stdin:
-            sys.stdout.write( data )
+    def add(self, result):
+        filename, changed, failed = result
+        if failed:
+            self.counts["failed"] += 1
+            self.operators.setdefault(failed, {"changed": 0, "failed": 0})["failed"] += 1
+            self._keep(failed, "failed", filename)
+        elif changed:
+            self.counts["changed"] += 1
         else:
-            if in_place:
-                out_name = filename
-            else:
-                out_name = filename + suffix
-            with open(out_name, "w") as fp:
-                fp.write( data )
+            self.counts["unchanged"] += 1
+        for name in changed:
+            self.operators[name]["changed"] += 1
+            self._keep(name, "changed", filename)
+    
+    def _keep(self, operator, outcome, filename):
+        if self.files is not None:
+            self.files.setdefault(operator, {"changed": [], "failed": []})[outcome].append(filename)
+    
+    def as_dict(self):
+        operators = {}
+        for name, counts in self.operators.items():
+            operators[name] = dict(counts)
+            if self.files is not None:
+                files = self.files.get(name, {})
+                operators[name]["changed_files"] = sorted(files.get("changed", []))
+                operators[name]["failed_files"] = sorted(files.get("failed", []))
+        return dict(self.counts, files=sum(self.counts.values()), operators=operators)
+    
+    def write(self, fp):
+        print >>fp, "%(changed)i files changed, %(unchanged)i unchanged, %(failed)i failed" % self.counts
+        for name in sorted(self.operators.keys()):
+            print >>fp, "  %s: %i changed, %i failed" % (name, self.operators[name]["changed"], self.operators[name]["failed"])
 
 def main():
     parser = ArgumentParser()
@@ -129,18 +330,43 @@ def main():
     parser.add_argument("-i", '--in-place', action="store_true", help="Demangle files in-place (possibly dangerous) [default: %(default)s]")
     parser.add_argument("-s", '--suffix', help="Suffix for demangled files, when not operating in-place [default: %(default)s]", default=".demangled")
     parser.add_argument("-n", '--dry-run', help="Don't actually write anything", action="store_true")
-    parser.add_argument(dest="file", help="Name of the message file(s) to demangle", metavar="file", nargs="*")
+    parser.add_argument("-u", '--unchanged', choices=["write", "link", "skip"], default="link", help="What to do with files that need no demangling, when not operating in-place: write a copy anyway, hardlink it, or skip it [default: %(default)s]")
+    parser.add_argument("-j", '--jobs', help="Number of processes to demangle with [default: %(default)s]", default=1, type=int)
+    parser.add_argument("-S", '--summary', action="store_true", help="Print a summary of changed, unchanged and failed files per operator at the end")
+    parser.add_argument('--scan', action="store_true", help="Don't write anything, only print which files each operator would change or fails on, as JSON")
+    parser.add_argument(dest="file", help="Name of the message file(s) to demangle, directories are searched for files", metavar="file", nargs="*")
 
     # Process arguments
     args = parser.parse_args()
     
     if len(args.file) == 0: args.file.append(None) 
+    if args.scan:
+        args.dry_run = True
     
-    for f in args.file:
+    jobs = ( (f, args.in_place, args.suffix, args.dry_run, args.unchanged)
+        for f in find_files(args.file, None if args.in_place else args.suffix) )
+    
+    summary = Summary(keep_files=args.scan)
+    if args.jobs > 1 and not None in args.file:
+        pool = multiprocessing.Pool(args.jobs)
         try:
-            handle_file(f, args.in_place, args.suffix, args.dry_run)
-        except Exception as e:
-            print >>sys.stderr, "%s: %s" % (f, e)
+            for result in pool.imap_unordered(_handle_file_job, jobs, chunksize=16):
+                summary.add(result)
+        finally:
+            pool.terminate()
+    else:
+        for job in jobs:
+            try:
+                summary.add( handle_file(*job) )
+            except Exception as e:
+                print >>sys.stderr, "%s: %s" % (job[0], e)
+                summary.add( (job[0], [], "error") )
+    
+    if args.summary:
+        summary.write(sys.stderr)
+    if args.scan:
+        json.dump(summary.as_dict(), sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,132 @@
+#!/usr/bin/env python2.7
+'''
+gggd export -- all retrieved messages of a group, ordered by date, as one mbox or maildir
+
+The messages of each topic are ordered by their Date header, read without the rest
+of the message, and the topics are merged. Besides the manifest only the date of
+each message and one message at a time are kept in memory, however large the group is.
+
+@author: henryk
+'''
+from argparse import ArgumentParser
+import sys
+import os
+import time
+import heapq
+import socket
+import email.utils
+
+from demangle import parse_headers, handle_data, ProcessingError
+from archive import ArchiveManifest, MboxStore, STORES, detect_format
+from index import parse_date
+
+def topic_messages(store, manifest, topic):
+    '''Yields (date, topic, message) for the messages of topic, ordered by date.
+    Messages without a (valid) Date header come first, with date 0.'''
+    keys = []
+    for message in manifest.topics.get(topic, {}).keys():
+        try:
+            head = store.read_head(topic, message, manifest.get(topic, message)[3])
+        except (IOError, OSError) as e:
+            print >>sys.stderr, "%s/%s: %s" % (topic, message, e)
+            continue
+        keys.append( (parse_date(parse_headers(head)["Date"]) or 0, message) )
+    keys.sort()
+    for date, message in keys:
+        yield date, topic, message
+
+def merged_messages(store, manifest):
+    '''Yields (date, topic, message) for all messages in manifest, ordered by date'''
+    return heapq.merge(*[ topic_messages(store, manifest, topic) for topic in sorted(manifest.topics) ])
+
+class MboxWriter(object):
+    '''Messages appended to an mbox file, with mboxrd escaping of From lines'''
+    def __init__(self, fp):
+        self.fp = fp
+
+    def add(self, data, date, sender):
+        data = MboxStore._escape.sub(r">\1", data)
+        self.fp.write("From %s %s\n" % (sender, time.asctime(time.gmtime(date))))
+        self.fp.write(data)
+        self.fp.write("\n" if data.endswith("\n") else "\n\n")
+
+    def close(self):
+        self.fp.flush()
+
+class MaildirWriter(object):
+    '''Messages delivered to the new/ directory of a maildir, named and dated so that
+    they sort in the order they were added'''
+    def __init__(self, dir_name):
+        self.dir_name = dir_name
+        for sub_dir in ("tmp", "new", "cur"):
+            if not os.path.isdir(os.path.join(dir_name, sub_dir)):
+                os.makedirs(os.path.join(dir_name, sub_dir))
+        self.host = socket.gethostname().replace("/", "\\057").replace(":", "\\072")
+        self.count = 0
+
+    def add(self, data, date, sender):
+        self.count += 1
+        name = "%010i.P%iQ%i.%s" % (date, os.getpid(), self.count, self.host)
+        temp_name = os.path.join(self.dir_name, "tmp", name)
+        with open(temp_name, "wb") as fp:
+            fp.write(data)
+        os.utime(temp_name, (date, date))
+        os.rename(temp_name, os.path.join(self.dir_name, "new", name))
+
+    def close(self):
+        pass
+
+def export(store, manifest, writer, demangle=False, verbose=False):
+    '''Write all messages in manifest to writer, ordered by date. Returns the number of messages.'''
+    count = 0
+    for date, topic, message in merged_messages(store, manifest):
+        try:
+            data = store.read(topic, message, manifest.get(topic, message)[3])
+        except (IOError, OSError) as e:
+            print >>sys.stderr, "%s/%s: %s" % (topic, message, e)
+            continue
+        if demangle:
+            try:
+                data = handle_data(data)
+            except ProcessingError as e:
+                print >>sys.stderr, "%s/%s: %s" % (topic, message, e.message)
+        # mbox and maildir use unix line ends
+        data = data.replace("\r\n", "\n")
+        sender = email.utils.parseaddr(parse_headers(data)["From"] or "")[1] or "MAILER-DAEMON"
+        if verbose: print >>sys.stderr, "Exporting %s/%s, %s" % (topic, message,
+            time.strftime("%Y-%m-%d %H:%M", time.gmtime(date)) if date else "no date")
+        writer.add(data, date, sender)
+        count += 1
+    writer.close()
+    return count
+
+def main(argv=None):
+    parser = ArgumentParser(prog="gggd export", description="Write all messages retrieved for a group, ordered by date, to one mbox file or maildir")
+    parser.add_argument("-v", "--verbose", action="store_true", help="List the messages that are exported (on stderr)")
+    parser.add_argument("-f", "--format", choices=sorted(STORES.keys()), help="Storage format of the group directory [default: detected]")
+    parser.add_argument("-d", "--demangle", action="store_true", help="Demangle message contents while exporting")
+    parser.add_argument("-m", "--maildir", action="store_true", help="Write a maildir (OUTPUT is its directory) instead of an mbox file")
+    parser.add_argument("-o", "--output", default="-", help="mbox file to write, or - for stdout [default: %(default)s]")
+    parser.add_argument(dest="group", help="Name of the group (directory)", metavar="group")
+    args = parser.parse_args(argv)
+
+    if args.maildir and args.output == "-":
+        parser.error("--maildir needs a directory given with -o")
+
+    store = STORES[args.format or detect_format(args.group)](args.group)
+    manifest = ArchiveManifest("%s.manifest" % args.group)
+    if not manifest.exists():
+        manifest.rebuild(store)
+
+    if args.maildir:
+        count = export(store, manifest, MaildirWriter(args.output), args.demangle, args.verbose)
+    elif args.output == "-":
+        count = export(store, manifest, MboxWriter(sys.stdout), args.demangle, args.verbose)
+    else:
+        with open(args.output, "wb") as fp:
+            count = export(store, manifest, MboxWriter(fp), args.demangle, args.verbose)
+    if args.verbose: print >>sys.stderr, "%i messages exported" % count
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -24,12 +24,36 @@ from argparse import ArgumentParser
 from argparse import RawDescriptionHelpFormatter
 import subprocess
 import xml.etree.ElementTree as ElementTree
-from contextlib import contextmanager
+from contextlib import contextmanager, nested
 import tempfile
-
-from demangle import handle_data, ProcessingError
-
-__all__ = []
+import httplib
+import urlparse
+import urllib2
+import cookielib
+import socket
+import threading
+import time
+import calendar
+import Queue
+import hashlib
+import collections
+import random
+import itertools
+import zlib
+import mmap
+import re
+import ConfigParser
+from HTMLParser import HTMLParser
+
+from demangle import handle_data, demangle_pieces, write_pieces, parse_headers, ProcessingError
+from archive import atomic_write, append_to, read_complete_lines, ArchiveManifest, TreeStore, STORES, detect_format
+import index
+import export
+import verify
+from stats import RunStatistics
+from workqueue import TopicQueue
+
+__all__ = ["iter_messages"]
 __version__ = 0.1
 __date__ = '2014-11-03'
 __updated__ = '2014-11-07'
@@ -38,7 +62,15 @@ DEBUG = 0
 TESTRUN = 0
 PROFILE = 0
 
+# Set by main, off when used as a library
+verbose = False
+batch_mode = False
+
 class LynxFetcher(object):
+    # lynx only reports HTTP errors on stderr in -listonly mode, see GroupInformation._fetch_x
+    reports_status = False
+    CHUNK_SIZE = 16*1024
+
     def __init__(self, lynx_cfg=None, lynx_cookie_file=None):
         self.lynx_cfg = lynx_cfg
         self.lynx_cookie_file = lynx_cookie_file
@@ -56,7 +88,9 @@ class LynxFetcher(object):
             ])
         return args
 
-    def fetch(self, url, list_only=False, source=False, header=False, stderr=False):
+    def fetch(self, url, list_only=False, source=False, header=False, stderr=False, request_headers=None, destination=None):
+        '''If destination (a file) is given, the data is written to it and data is destination'''
+        # request_headers are ignored, lynx can't send additional headers
         args = ["lynx", "-dump"]
         args.extend( self.default_params() )
         if list_only:
@@ -72,18 +106,32 @@ class LynxFetcher(object):
         args.append(url)
 
         p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        data, errors = p.communicate()
-
-        if header:
-            if stderr:
-                return data.split("\r\n\r\n", 1) + [errors]
-            else:
-                return data.split("\r\n\r\n", 1)
+        if destination is None:
+            data, errors = p.communicate()
+            result = data.split("\r\n\r\n", 1) if header else [data]
         else:
-            if stderr:
-                return data, errors
-            else:
-                return data
+            header_data = self._stream(p.stdout, destination, header)
+            errors = p.stderr.read()
+            p.wait()
+            result = [header_data, destination] if header else [destination]
+
+        if stderr:
+            result.append(errors)
+        return result if len(result) > 1 else result[0]
+
+    def _stream(self, fp, destination, header):
+        '''Copy the output of lynx from fp to destination. With header, the MIME header in
+        front of the data isn't copied but returned.'''
+        head = ""
+        for chunk in iter(lambda: fp.read(self.CHUNK_SIZE), ""):
+            if header:
+                head += chunk
+                if not "\r\n\r\n" in head:
+                    continue
+                head, chunk = head.split("\r\n\r\n", 1)
+                header = False
+            destination.write(chunk)
+        return head
 
     def interactive(self, url):
         args = ["lynx", "-child", "-nopause"]
@@ -130,6 +178,784 @@ class LynxFetcher(object):
         else:
             yield
 
+class LinkExtractor(object):
+    '''Collects all link targets of a HTML page, like lynx -listonly does, from the
+    page as it is received: feed it the page in pieces, then call close.
+
+    Also collects the last post date that topic pages show next to each topic
+    link, in last_posts, keyed by link target.
+
+    Only looks for <a href> and elements with class lastPostDate, with a regular
+    expression, instead of parsing all of the HTML.'''
+    _matches = re.compile(r'''<a\s[^>]*?\bhref\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>"']+))'''
+        r'''|\bclass\s*=\s*(?:"[^"]*\blastPostDate\b[^"]*"|'[^']*\blastPostDate\b[^']*')[^>]*>([^<]*)''', re.I)
+    _unescape = HTMLParser().unescape
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.links = []
+        self.last_posts = {}
+        self.buffer = ""
+        # Bytes fed, and seconds spent on them, for the statistics
+        self.size = 0
+        self.parse_time = 0.0
+
+    def feed(self, data):
+        started = time.time()
+        self.size += len(data)
+        self.buffer = self.buffer + data
+        # Everything up to the last '<' is complete, the rest may continue in the next piece
+        end = self.buffer.rfind("<")
+        if end > 0:
+            self._scan(end)
+            self.buffer = self.buffer[end:]
+        self.parse_time += time.time() - started
+
+    def close(self):
+        started = time.time()
+        self._scan(len(self.buffer))
+        self.buffer = ""
+        self.parse_time += time.time() - started
+
+    def _scan(self, end):
+        for m in self._matches.finditer(self.buffer, 0, end):
+            href = m.group(1) or m.group(2) or m.group(3)
+            if href:
+                if "&" in href:
+                    href = self._unescape(href.decode("utf-8", "replace")).encode("utf-8")
+                if not href.startswith("http"):
+                    href = urlparse.urljoin(self.base_url, href)
+                self.links.append(href)
+            elif m.group(4) is not None and self.links:
+                self.last_posts[self.links[-1]] = " ".join(m.group(4).split())
+
+class _FeedTarget(object):
+    '''ElementTree parser target collecting the links of the items of a RSS or Atom feed'''
+    def __init__(self):
+        self.links = []
+        self.tags = []
+        self.text = []
+        self.href = None
+
+    def start(self, tag, attrib):
+        self.tags.append(tag.split("}")[-1])
+        self.text = []
+        self.href = attrib.get("href")
+
+    def end(self, tag):
+        tag = self.tags.pop()
+        if tag == "link" and self.tags and self.tags[-1] in ("item", "entry"):
+            link = "".join(self.text).strip() or self.href
+            if link:
+                self.links.append(link)
+
+    def data(self, data):
+        self.text.append(data)
+
+    def close(self):
+        return self.links
+
+class FeedLinks(object):
+    '''Collects the links of the items of a RSS (or Atom) feed, from the feed as it is
+    received: feed it in pieces, then call close. Only the links are kept, not the
+    document. Data that isn't a well-formed feed (e.g. an error page) doesn't raise
+    an exception, error is set instead.'''
+    def __init__(self, base_url):
+        self.target = _FeedTarget()
+        self.parser = ElementTree.XMLParser(target=self.target)
+        self.links = self.target.links
+        self.error = None
+        self.size = 0
+        self.parse_time = 0.0
+
+    def feed(self, data):
+        started = time.time()
+        self.size += len(data)
+        if self.error is None:
+            try:
+                self.parser.feed(data)
+            except ElementTree.ParseError as e:
+                self.error = e
+        self.parse_time += time.time() - started
+
+    def close(self):
+        started = time.time()
+        if self.error is None:
+            try:
+                self.parser.close()
+            except ElementTree.ParseError as e:
+                self.error = e
+        self.parse_time += time.time() - started
+
+class _ResponseInfo(object):
+    '''Minimal adapter to let cookielib look at a httplib response'''
+    def __init__(self, response):
+        self.response = response
+    def info(self):
+        return self.response.msg
+
+class HTTPFetcher(object):
+    '''Fetcher that talks HTTP itself, over persistent keep-alive connections.
+
+    Has the same interface as LynxFetcher and reads and writes lynx' cookie file
+    format, so that a cookie file prepared with lynx can be used. lynx is still
+    used for the interactive login.'''
+    reports_status = True
+
+    USER_AGENT = "Lynx/2.8.8rel.2 libwww-FM/2.14 SSL-MM/1.4.1"
+    MAX_REDIRECTS = 10
+    TIMEOUT = 60
+    CHUNK_SIZE = 16*1024
+
+    # Connections are kept per thread, and shared by all fetchers (cookies are per request)
+    local = threading.local()
+
+    def __init__(self, lynx_cfg=None, lynx_cookie_file=None):
+        self.lynx = LynxFetcher(lynx_cfg, lynx_cookie_file)
+        self.cookie_file = lynx_cookie_file
+        self.cookie_save_file = lynx_cookie_file
+        if not self.cookie_file and lynx_cfg:
+            self.cookie_file, self.cookie_save_file = self._cookie_files_from_cfg(lynx_cfg)
+        self.cookies = cookielib.CookieJar()
+        self.load_cookies()
+
+    @staticmethod
+    def _cookie_files_from_cfg(lynx_cfg):
+        settings = {}
+        with open(lynx_cfg, "r") as fp:
+            for line in fp:
+                if line.startswith("#") or not ":" in line:
+                    continue
+                k, v = line.split(":", 1)
+                settings[k.strip().upper()] = v.strip()
+
+        if not settings.get("SET_COOKIES", "TRUE").startswith("TRUE"):
+            return None, None
+        cookie_file = settings.get("COOKIE_FILE")
+        cookie_save_file = settings.get("COOKIE_SAVE_FILE", cookie_file)
+        if not settings.get("PERSISTENT_COOKIES", "FALSE").startswith("TRUE"):
+            cookie_save_file = None
+        return (expanduser(cookie_file) if cookie_file else None,
+            expanduser(cookie_save_file) if cookie_save_file else None)
+
+    def load_cookies(self):
+        '''Read the cookie file, which is in the (headerless) Netscape format lynx uses'''
+        if not self.cookie_file or not os.path.exists(self.cookie_file):
+            return
+        with open(self.cookie_file, "r") as fp:
+            for line in fp:
+                line = line.rstrip("\r\n")
+                if not line or line.startswith("#"):
+                    continue
+                fields = line.split("\t")
+                if len(fields) != 7:
+                    continue
+                domain, domain_specified, path, secure, expires, name, value = fields
+                expires = int(expires) if expires.isdigit() and int(expires) > 0 else None
+                self.cookies.set_cookie(cookielib.Cookie(0, name, value, None, False,
+                    domain, domain_specified == "TRUE", domain.startswith("."),
+                    path, True, secure == "TRUE", expires, expires is None,
+                    None, None, {}))
+
+    def save_cookies(self):
+        if not self.cookie_save_file:
+            return
+        fd, temp_name = tempfile.mkstemp(dir=os.path.dirname(self.cookie_save_file) or ".")
+        with os.fdopen(fd, "w") as fp:
+            for c in self.cookies:
+                if c.discard:
+                    continue
+                fp.write("\t".join([c.domain, "TRUE" if c.domain.startswith(".") else "FALSE",
+                    c.path, "TRUE" if c.secure else "FALSE", str(c.expires or 0),
+                    c.name, c.value if c.value is not None else ""]) + "\n")
+        os.rename(temp_name, self.cookie_save_file)
+
+    def _connection(self, scheme, netloc):
+        # httplib connections must not be shared between threads
+        connections = self.local.__dict__.setdefault("connections", {})
+        conn = connections.get( (scheme, netloc) )
+        if conn is None:
+            if scheme == "https":
+                conn = httplib.HTTPSConnection(netloc, timeout=self.TIMEOUT)
+            else:
+                conn = httplib.HTTPConnection(netloc, timeout=self.TIMEOUT)
+            connections[ (scheme, netloc) ] = conn
+        return conn
+
+    def _drop_connection(self, scheme, netloc):
+        conn = self.local.__dict__.get("connections", {}).pop( (scheme, netloc), None )
+        if conn is not None:
+            conn.close()
+
+    def request(self, url, request_headers=None, consumer=None, compressed=False):
+        '''Perform a GET request, following redirects. Returns (response, body).
+
+        If consumer is given, it is called with the pieces of the final response body
+        as they are received, and body is empty. With compressed, the body may be sent
+        gzip or deflate compressed, and is decompressed (in pieces of at most CHUNK_SIZE).'''
+        for _ in range(self.MAX_REDIRECTS):
+            scheme, netloc, path, query, _ = urlparse.urlsplit(url)
+            selector = urlparse.urlunsplit( ("", "", path or "/", query, "") )
+
+            cookie_request = urllib2.Request(url)
+            self.cookies.add_cookie_header(cookie_request)
+            headers = {"User-Agent": self.USER_AGENT, "Accept": "*/*"}
+            if compressed:
+                headers["Accept-Encoding"] = "gzip, deflate"
+            headers.update(cookie_request.unredirected_hdrs)
+            headers.update(request_headers or {})
+
+            for attempt in (0, 1):
+                conn = self._connection(scheme, netloc)
+                try:
+                    conn.request("GET", selector, headers=headers)
+                    response = conn.getresponse()
+                    break
+                except (httplib.HTTPException, socket.error):
+                    # A keep-alive connection may have been closed by the server in the meantime, retry once
+                    self._drop_connection(scheme, netloc)
+                    if attempt:
+                        raise
+
+            location = response.getheader("Location")
+            redirect = response.status in (301, 302, 303, 307) and location
+            try:
+                if consumer is None or redirect:
+                    body = response.read()
+                    if compressed and not redirect:
+                        body = "".join(self._decompressed(response, [body]))
+                else:
+                    body = ""
+                    chunks = iter(lambda: response.read(self.CHUNK_SIZE), "")
+                    for chunk in self._decompressed(response, chunks) if compressed else chunks:
+                        consumer(chunk)
+            except (httplib.HTTPException, socket.error, zlib.error):
+                self._drop_connection(scheme, netloc)
+                raise
+
+            if response.will_close:
+                self._drop_connection(scheme, netloc)
+
+            self.cookies.extract_cookies(_ResponseInfo(response), cookie_request)
+
+            if redirect:
+                url = urlparse.urljoin(url, location)
+                continue
+            return response, body
+
+        raise httplib.HTTPException("%s: Too many redirects" % url)
+
+    def _decompressed(self, response, chunks):
+        '''The pieces of a body received in chunks, decompressed according to the
+        Content-Encoding of response'''
+        encoding = (response.getheader("Content-Encoding") or "identity").lower()
+        if encoding == "identity":
+            for chunk in chunks:
+                yield chunk
+            return
+        if not encoding in ("gzip", "deflate"):
+            raise httplib.HTTPException("Unsupported Content-Encoding %s" % encoding)
+        # gzip or zlib header, detected automatically
+        decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            # Limited output, highly compressed data could be much larger than the chunk
+            while chunk:
+                yield decompressor.decompress(chunk, self.CHUNK_SIZE)
+                chunk = decompressor.unconsumed_tail
+        yield decompressor.flush()
+
+    def fetch(self, url, list_only=False, source=False, header=False, stderr=False, request_headers=None, parser=None, destination=None):
+        '''Like LynxFetcher.fetch. If parser is given (e.g. LinkExtractor), the data is
+        parser(url), fed the page while it was received. If destination (a file) is given,
+        the data is received compressed if the server supports that, written to destination
+        decompressed, and data is destination.'''
+        if destination is not None:
+            response, data = self.request(url, request_headers, destination.write, compressed=True)
+            data = destination
+        elif parser:
+            page_parser = parser(url)
+            response, data = self.request(url, request_headers, page_parser.feed)
+            page_parser.close()
+            data = page_parser
+        else:
+            response, data = self.request(url, request_headers)
+
+        if list_only:
+            extractor = LinkExtractor(url)
+            extractor.feed(data)
+            extractor.close()
+            data = "\nReferences\n\n" + "".join( "%4i. %s\n" % (n+1, l) for n, l in enumerate(extractor.links) )
+
+        if header:
+            header_data = "\r\n".join(["HTTP/%s %s %s" % ("1.0" if response.version == 10 else "1.1", response.status, response.reason)]
+                + [l.rstrip("\r\n") for l in response.msg.headers])
+            result = [header_data, data]
+        else:
+            result = [data]
+
+        if stderr:
+            result.append("")
+        return result if len(result) > 1 else result[0]
+
+    def interactive(self, url):
+        with self.lynx.temp_context():
+            self.lynx.interactive(url)
+        # Pick up whatever cookies lynx stored during the session
+        self.load_cookies()
+
+    def has_cookies(self):
+        return self.cookie_file is not None
+
+    @contextmanager
+    def temp_context(self):
+        try:
+            yield
+        finally:
+            self.save_cookies()
+
+FETCHERS = {"http": HTTPFetcher, "lynx": LynxFetcher}
+
+class RateLimiter(object):
+    '''Token bucket limiting requests per second, plus a cap on the number of requests in flight.
+
+    Use as a context manager around each request, shared between all threads. The final
+    result of each request (after retries) is reported with report(). After every WINDOW
+    results: when too many of them failed, both limits are halved, when few failed, they
+    are raised a step.'''
+    WINDOW = 20
+    MAX_ERROR_RATE = 0.25
+    RECOVER_ERROR_RATE = 0.1
+    MIN_RATE = 0.2
+
+    def __init__(self, rate=None, max_in_flight=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.max_in_flight = max_in_flight
+        self.in_flight_limit = max_in_flight
+        self.in_flight = 0
+        self.tokens = 1.0
+        self.last = time.time()
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.results = collections.deque(maxlen=self.WINDOW)
+        self.started = collections.deque(maxlen=self.WINDOW)
+
+    def _take_token(self):
+        while True:
+            with self.lock:
+                if not self.rate:
+                    return
+                now = time.time()
+                self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def __enter__(self):
+        with self.condition:
+            while self.in_flight_limit and self.in_flight >= self.in_flight_limit:
+                self.condition.wait(1)
+            self.in_flight += 1
+            self.started.append(time.time())
+        self._take_token()
+        return self
+
+    def __exit__(self, *exc_info):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+        return False
+
+    def report(self, success):
+        global verbose
+        with self.lock:
+            self.results.append(success)
+            if len(self.results) < self.WINDOW:
+                return
+            errors = self.results.count(False)
+            self.results.clear()
+            if errors > self.MAX_ERROR_RATE * self.WINDOW:
+                if self.rate is None:
+                    # Start from the rate that has been reached so far
+                    elapsed = self.started[-1] - self.started[0]
+                    self.rate = len(self.started) / elapsed if elapsed > 0 else 10.0
+                self.rate = max(self.MIN_RATE, self.rate / 2)
+                self.in_flight_limit = max(1, (self.in_flight_limit or self.in_flight) // 2)
+                if verbose: print "Many errors, slowing down to %.1f requests/s, %i in flight" % (self.rate, self.in_flight_limit)
+            elif errors <= self.RECOVER_ERROR_RATE * self.WINDOW and (self.rate != self.max_rate or self.in_flight_limit != self.max_in_flight):
+                if self.rate is not None:
+                    self.rate = self.rate * 1.5
+                    if self.max_rate is None and self.rate > 100:
+                        self.rate = None
+                    elif self.max_rate is not None:
+                        self.rate = min(self.rate, self.max_rate)
+                if self.in_flight_limit is not None:
+                    self.in_flight_limit = self.in_flight_limit + 1
+                    if self.max_in_flight is None or self.in_flight_limit >= self.max_in_flight:
+                        self.in_flight_limit = self.max_in_flight
+                self.condition.notify_all()
+
+class RetryPolicy(object):
+    '''Decides whether and when a failed request is repeated: up to attempts times in
+    total, with exponential backoff and jitter, and no more than budget retries per run.'''
+    # 403 is not retried, it's the usual answer when not logged in
+    RETRY_CODES = (429, 500, 502, 503, 504)
+    # but a 500 for a raw message means that it has been deleted
+    FINAL_CODES = {"raw_message": (500,)}
+
+    def __init__(self, attempts=3, budget=1000, base_delay=1.0, max_delay=60.0):
+        self.attempts = attempts
+        self.budget = budget
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+
+    def should_retry(self, attempt):
+        '''attempt is the number of the attempt that failed, starting at 1'''
+        if attempt >= self.attempts:
+            return False
+        with self.lock:
+            if self.budget <= 0:
+                return False
+            self.budget -= 1
+            return True
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+class DeadLetters(object):
+    '''URLs of messages that could not be retrieved, kept in a file next to the group
+    directory to retry them later with --retry-failed. If shared, other processes are
+    adding URLs to the file as well.
+
+    URLs are told apart by group, topic and message only, so that a URL is found
+    whatever base URL and organization it was written with.'''
+    def __init__(self, file_name, shared=False):
+        self.file_name = file_name
+        self.shared = shared
+        self.lock = threading.Lock()
+        self.fp = None
+        self.load()
+
+    @staticmethod
+    def key(url):
+        '''group/topic/message of a raw message URL'''
+        return url.rsplit("msg=", 1)[-1]
+
+    @property
+    def urls(self):
+        return self.entries.values()
+
+    def load(self):
+        with self.lock:
+            self.entries = dict( (self.key(u), u) for u in read_complete_lines(self.file_name, truncate=not self.shared)
+                if len(self.key(u).split("/")) == 3 )
+
+    def add(self, url):
+        with self.lock:
+            if self.key(url) in self.entries:
+                return
+            self.entries[self.key(url)] = url
+            if self.fp is None:
+                self.fp = open(self.file_name, "a")
+            append_to(self.fp, url + "\n", self.shared)
+
+    def discard(self, url):
+        with self.lock:
+            self.entries.pop(self.key(url), None)
+
+    def close(self):
+        '''Write out the remaining URLs, without those that have been retrieved since.
+        A shared file only gets the URLs that were added.'''
+        with self.lock:
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+            if self.shared:
+                return
+            if self.entries:
+                atomic_write(self.file_name, "".join(u + "\n" for u in sorted(self.entries.values())))
+            elif os.path.exists(self.file_name):
+                os.unlink(self.file_name)
+
+def map_file(fp):
+    '''The contents of the file fp, mapped into memory (read-only)'''
+    fp.flush()
+    if os.fstat(fp.fileno()).st_size == 0:
+        # Empty files can't be mapped
+        return ""
+    return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+def run_parallel(function, items, jobs=1):
+    '''Call function(*item) for all items, with up to jobs threads.
+
+    function is expected to report its own errors, an exception escaping from it
+    is printed and doesn't stop the other items.'''
+    def call(item):
+        try:
+            function(*item)
+        except Exception as e:
+            print >>sys.stderr, "%s: %s" % ("/".join(item), e)
+
+    if jobs <= 1:
+        for item in items:
+            call(item)
+        return
+
+    work = Queue.Queue()
+    for item in items:
+        work.put(item)
+
+    def worker():
+        while True:
+            try:
+                item = work.get_nowait()
+            except Queue.Empty:
+                return
+            call(item)
+
+    threads = [threading.Thread(target=worker) for _ in range(jobs)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    try:
+        _join_all(threads)
+    except KeyboardInterrupt:
+        # Let the workers finish what they're doing, but don't start anything new
+        print >>sys.stderr, "Interrupted, waiting for running requests to finish ..."
+        with work.mutex:
+            work.queue.clear()
+        _join_all(threads)
+        raise
+
+def _join_all(threads):
+    for t in threads:
+        # Join with timeout, otherwise KeyboardInterrupt isn't delivered to the main thread
+        while t.is_alive():
+            t.join(1)
+
+class PipelineStage(object):
+    '''Threads calling function(*item) for each item put into a bounded priority queue,
+    lowest priority first (items with the same priority in the order they were put).
+    put blocks while the queue is full, so a fast producer can't run away from a slow
+    stage. close waits until all items are done.'''
+    LAST = sys.maxint
+
+    def __init__(self, function, jobs=1, size=100):
+        self.function = function
+        self.queue = Queue.PriorityQueue(size)
+        self.counter = itertools.count()
+        self.aborted = False
+        self.threads = [threading.Thread(target=self._worker) for _ in range(max(jobs, 1))]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def put(self, priority, *item):
+        if not self.aborted:
+            self.queue.put( (priority, next(self.counter), item) )
+
+    def _worker(self):
+        while True:
+            priority, n, item = self.queue.get()
+            if priority == self.LAST:
+                return
+            try:
+                self.function(*item)
+            except Exception as e:
+                print >>sys.stderr, "%s: %s" % ("/".join(item), e)
+
+    def close(self):
+        for t in self.threads:
+            self.queue.put( (self.LAST, next(self.counter), None) )
+        _join_all(self.threads)
+
+    def abort(self):
+        '''Drop all waiting items and don't accept new ones, running items are finished'''
+        self.aborted = True
+        with self.queue.mutex:
+            del self.queue.queue[:]
+            self.queue.not_full.notify_all()
+
+class _Batch(object):
+    '''Counts the outstanding items of one FairScheduler.map call'''
+    def __init__(self, count):
+        self.count = count
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        if count == 0:
+            self.finished.set()
+
+    def done(self, count=1):
+        with self.lock:
+            self.count -= count
+            if self.count <= 0:
+                self.finished.set()
+
+class FairScheduler(object):
+    '''Threads shared by several groups. Work is taken from the groups in turn, so that a
+    group with many messages to retrieve doesn't hold up the others.'''
+    def __init__(self, jobs=1):
+        self.condition = threading.Condition()
+        self.queues = {}                   # group -> deque of (function, item, batch)
+        self.turns = collections.deque()   # groups, in the order they get the next turn
+        self.aborted = False
+        self.threads = [threading.Thread(target=self._worker) for _ in range(max(jobs, 1))]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def map(self, group, function, items):
+        '''Call function(*item) for all items, returns when all are done'''
+        items = list(items)
+        batch = _Batch(len(items))
+        with self.condition:
+            if self.aborted:
+                return
+            if not group in self.queues:
+                self.queues[group] = collections.deque()
+                self.turns.append(group)
+            self.queues[group].extend( (function, item, batch) for item in items )
+            self.condition.notify_all()
+        batch.finished.wait()
+
+    def _next(self):
+        for _ in range(len(self.turns)):
+            group = self.turns[0]
+            self.turns.rotate(-1)
+            if self.queues[group]:
+                return self.queues[group].popleft()
+        return None
+
+    def _worker(self):
+        while True:
+            with self.condition:
+                task = self._next()
+                while task is None:
+                    self.condition.wait()
+                    task = self._next()
+            function, item, batch = task
+            try:
+                function(*item)
+            except Exception as e:
+                print >>sys.stderr, "%s: %s" % ("/".join(item), e)
+            batch.done()
+
+    def abort(self):
+        '''Drop all waiting work, running work is finished'''
+        with self.condition:
+            self.aborted = True
+            for queue in self.queues.values():
+                while queue:
+                    queue.popleft()[2].done()
+
+class CrawlJournal(object):
+    '''Append-only record of the finished parts of a full crawl: topic pages, topic
+    listings and messages. An interrupted crawl is resumed from it without repeating
+    any finished request. Lines are only appended and flushed when the work is done,
+    an incomplete last line (the process was killed while writing it) is dropped.'''
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.pages = {}        # page url -> (next page url, [topics])
+        self.listings = {}     # topic -> [messages]
+        self.messages = set()  # (topic, message)
+        self.lock = threading.Lock()
+        self.load()
+        self.fp = open(self.file_name, "a")
+
+    def load(self):
+        for line in read_complete_lines(self.file_name):
+            fields = line.split("\t")
+            if fields[0] == "P" and len(fields) == 4:
+                self.pages[fields[1]] = (fields[2] or None, fields[3].split())
+            elif fields[0] == "L" and len(fields) == 3:
+                self.listings[fields[1]] = fields[2].split()
+            elif fields[0] == "M" and len(fields) == 3:
+                self.messages.add( (fields[1], fields[2]) )
+
+    def _append(self, *fields):
+        with self.lock:
+            self.fp.write("\t".join(fields) + "\n")
+            self.fp.flush()
+
+    def page_done(self, url, next_page, topics):
+        self.pages[url] = (next_page, topics)
+        self._append("P", url, next_page or "", " ".join(topics))
+
+    def listing_done(self, topic, messages):
+        self.listings[topic] = messages
+        self._append("L", topic, " ".join(messages))
+
+    def message_done(self, topic, message):
+        self.messages.add( (topic, message) )
+        self._append("M", topic, message)
+
+    def finish(self):
+        '''The crawl is complete, the next one should start from the beginning'''
+        self.fp.close()
+        os.unlink(self.file_name)
+
+TopicFingerprint = collections.namedtuple("TopicFingerprint", "messages_hash last_post etag last_modified")
+
+class TopicFingerprints(object):
+    '''What each topic listing looked like when it was last retrieved: a hash of its
+    message IDs, the last post date shown on the topic page, and ETag and Last-Modified
+    if the server sent them. Used to skip topics that haven't changed since.
+
+    Append-only file next to the group directory, the last line for a topic counts.
+    If shared, other processes are appending to it as well, and it isn't compacted.'''
+    def __init__(self, file_name, use_existing=True, shared=False):
+        self.file_name = file_name
+        self.use_existing = use_existing
+        self.shared = shared
+        self.fingerprints = {}
+        self.lock = threading.Lock()
+        lines = read_complete_lines(self.file_name, truncate=not shared)
+        for line in lines:
+            fields = line.split("\t")
+            if len(fields) == 5:
+                self.fingerprints[fields[0]] = TopicFingerprint( *[f or None for f in fields[1:]] )
+        if not shared and len(lines) > 2 * len(self.fingerprints) + 100:
+            self.compact()
+        self.fp = open(self.file_name, "a")
+
+    @staticmethod
+    def messages_hash(messages):
+        return hashlib.sha1( "\n".join(sorted(messages)) ).hexdigest()
+
+    def get(self, topic):
+        return self.fingerprints.get(topic) if self.use_existing else None
+
+    def set(self, topic, fingerprint):
+        with self.lock:
+            self.fingerprints[topic] = fingerprint
+            append_to(self.fp, "\t".join([topic] + [f or "" for f in fingerprint]) + "\n", self.shared)
+
+    def compact(self):
+        atomic_write(self.file_name, "".join( "\t".join([topic] + [f or "" for f in fingerprint]) + "\n"
+            for topic, fingerprint in self.fingerprints.iteritems() ))
+
+class MessageRecord(object):
+    '''What is kept in GroupInformation.topics about a message once its content is on disk'''
+    __slots__ = ("status", "size")
+
+    WRITTEN = "written"
+    EXISTS = "exists"
+    FAILED = "failed"
+
+    def __init__(self, status, size=None):
+        self.status = status
+        self.size = size
+
+    def __repr__(self):
+        return "MessageRecord(%r, %r)" % (self.status, self.size)
+
+# Records aren't changed, all messages that were retrieved before share one
+MessageRecord.KNOWN = MessageRecord(MessageRecord.EXISTS)
+
 class HTTPHeader(object):
     def __init__(self, header_data):
         self.data = header_data.splitlines()
@@ -137,97 +963,375 @@ class HTTPHeader(object):
         self.code = int(self.status_line.split()[1])
         self.message = self.status_line.split(None,2)[2]
 
+    def get(self, name, default=None):
+        name = name.lower()
+        for l in self.data[1:]:
+            if ":" in l and l.split(":", 1)[0].strip().lower() == name:
+                return l.split(":", 1)[1].strip()
+        return default
+
+
+BASE_URL = "https://groups.google.com"
 
 class GroupInformation(object):
-    def __init__(self, fetcher, group_name, organization=None):
+    def __init__(self, fetcher, group_name, organization=None, jobs=1, limiter=None, demangle=False, journal=None, manifest=None, fingerprints=None,
+            retry_policy=None, dead_letters=None, store=None, scheduler=None, base_url=None, stats=None, quiet=False, temp_dir=None):
         self.fetcher = fetcher
         self.group_name = group_name
         self.org_path = "/a/%s" % organization if organization else ''
+        self.base_url = (base_url or BASE_URL).rstrip("/") + self.org_path
+        # Links on topic pages and topic listings
+        base = re.escape("%s/" % self.base_url)
+        self.topic_link = re.compile(base + re.escape("d/topic/%s/" % group_name) + "([^/]+)$")
+        self.message_link = re.compile(base + re.escape("d/msg/%s/" % group_name) + "([^/]+)/([^/]+)$")
+        self.next_page_link = re.compile(base + re.escape("forum/?_escaped_fragment_=forum/"))
+        self.jobs = jobs
+        # A FairScheduler shared with other groups, instead of own threads
+        self.scheduler = scheduler
+        self.limiter = limiter or RateLimiter()
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.dead_letters = dead_letters
+        self.stats = (stats or RunStatistics()).group(group_name)
+        self.demangle = demangle
+        self.journal = journal
+        self.manifest = manifest
+        # Packed stores need the manifest to find messages
+        self.store = store or TreeStore(group_name)
+        self.fingerprints = fingerprints
+        # topic -> last post date, as shown on the topic pages
+        self.last_posts = {}
+        # topic -> message -> None (not retrieved yet), message content, or MessageRecord
         self.topics = {}
         self.had_500 = False
         self.had_403 = False
+        # Don't list the written messages on stdout
+        self.quiet = quiet
+        # For messages while they are received, next to the group directory by default
+        self.temp_dir = temp_dir or os.path.dirname(os.path.abspath(group_name))
+        self.aborted = False
+
+    # Maximum number of topics waiting to be listed, and of messages waiting to be retrieved
+    PIPELINE_QUEUE_SIZE = 100
 
     def fetch(self, topic_page_limit=None):
-        self.fetch_topics(topic_page_limit)
-        self.fetch_messages()
-        self.fetch_content()
+        '''Full crawl. Topic pages, topic listings and message contents are retrieved at
+        the same time: each topic is listed as soon as it is found on a topic page, each
+        message retrieved as soon as it is found in a listing. Topics are numbered in the
+        order of the topic pages, which show the most recently active topics first, and
+        lower numbers are listed and retrieved first.
+
+        With a shared scheduler, the phases run one after the other instead, each using
+        the scheduler.'''
+        global verbose
+        if self.scheduler:
+            complete = self.fetch_topics(topic_page_limit)
+            self.fetch_messages()
+            self.fetch_content()
+            self._finish_crawl(complete)
+            return
+
+        downloads = PipelineStage(self.fetch_message, self.jobs, self.PIPELINE_QUEUE_SIZE)
+        order = {}
 
-    def fetch_topics(self, page_limit=None):
+        def list_topic(topic):
+            if self.interrupted():
+                return
+            self.fetch_messages_topic(topic)
+            for message, content in self.topics[topic].items():
+                if content is None:
+                    downloads.put(order[topic], topic, message)
+        listings = PipelineStage(list_topic, self.jobs, self.PIPELINE_QUEUE_SIZE)
+
+        def add_topics(topics):
+            for topic in topics:
+                if not topic in order:
+                    order[topic] = len(order)
+                    listings.put(order[topic], topic)
+
+        pager_error = []
+        complete = []
+        def fetch_pages():
+            try:
+                complete.append(self.fetch_topics(topic_page_limit, add_topics))
+            except Exception:
+                pager_error.append(sys.exc_info())
+
+        pager = threading.Thread(target=fetch_pages)
+        pager.daemon = True
+        pager.start()
+        try:
+            _join_all([pager])
+            listings.close()
+            downloads.close()
+        except KeyboardInterrupt:
+            print >>sys.stderr, "Interrupted, waiting for running requests to finish ..."
+            # No more topic pages and listings either
+            self.abort()
+            listings.abort()
+            downloads.abort()
+            _join_all([pager])
+            listings.close()
+            downloads.close()
+            raise
+        if pager_error:
+            raise pager_error[0][0], pager_error[0][1], pager_error[0][2]
+        if verbose: print "Retrieved %i topics" % len(order)
+        self._finish_crawl(complete == [True])
+
+    def _finish_crawl(self, complete):
+        '''Drop the journal if all topic pages were read and the crawl wasn't stopped,
+        otherwise keep it so that the next run continues the crawl'''
+        if complete and not self.interrupted():
+            if self.journal:
+                self.journal.finish()
+        elif not self.interrupted():
+            print >>sys.stderr, "Not all topic pages could be retrieved, run gggd again to continue the crawl."
+
+    def fetch_topics(self, page_limit=None, on_topics=None):
+        '''Retrieve the topic pages and add the topics to self.topics. If on_topics is
+        given, it is called with the list of topics on each page as soon as it is read,
+        no further pages are retrieved when it returns True. Returns False if a topic
+        page could not be retrieved or the crawl was stopped, True otherwise.'''
         global verbose
         if verbose: print "Fetching topics ..."
-        next_page = "https://groups.google.com%s/forum/?_escaped_fragment_=forum/%s" % (self.org_path, self.group_name)
-        while next_page and page_limit is None or page_limit > 0:
-            if verbose: print "Fetching %s" % next_page
-            header, data = self._fetch_x(next_page, list_only=True)
-            if header.code != 200:
-                print >>sys.stderr, "Error: %s: %s" % (next_page, header.status_line)
-                return
-
-            next_page = self.parse_topics(data)
+        next_page = "%s/forum/?_escaped_fragment_=forum/%s" % (self.base_url, self.group_name)
+        while next_page and (page_limit is None or page_limit > 0) and not self.interrupted():
+            if self.journal and next_page in self.journal.pages:
+                if verbose: print "Skipping %s, done in previous run" % next_page
+                page, (next_page, topics) = next_page, self.journal.pages[next_page]
+                for t in topics:
+                    self.topics.setdefault(t, {})
+                if on_topics and on_topics(topics):
+                    return True
+            else:
+                if verbose: print "Fetching %s" % next_page
+                header, links, last_posts = self._fetch_links(next_page)
+                if header.code != 200:
+                    print >>sys.stderr, "Error: %s: %s" % (next_page, header.status_line)
+                    return False
+
+                page, (next_page, topics) = next_page, self.add_topic_links(links, last_posts)
+                if self.journal:
+                    self.journal.page_done(page, next_page, topics)
+                if on_topics and on_topics(topics):
+                    return True
             if page_limit is not None:
                 page_limit = page_limit - 1
-
-    def parse_topics(self, data):
+        return not self.interrupted()
+
+    def _fetch_links(self, url, request_headers=None):
+        '''Retrieve a page and list the links on it. Returns (header, links, last_posts),
+        see LinkExtractor. lynx only lists the links, last_posts is empty then.'''
+        if self.fetcher.reports_status:
+            header, extractor = self._fetch_x(url, parser=LinkExtractor, request_headers=request_headers)
+            return header, extractor.links, extractor.last_posts
+
+        header, data = self._fetch_x(url, list_only=True, request_headers=request_headers)
+        links = []
+        with self.stats.timer("parse_%s" % self.url_kind(url)):
+            for line in data.splitlines():
+                parts = line.split()
+                if len(parts) > 1:
+                    links.append(parts[1])
+        return header, links, {}
+
+    def add_topic_links(self, links, last_posts={}):
+        '''Add the topics among links to self.topics, returns the next topic page and the topics'''
         global verbose
         next_page = None
-        for line in data.splitlines():
-            parts = line.split()
-            # print parts
-            if len(parts) > 1 and parts[1].startswith("https://groups.google.com%s/d/topic/%s" % (self.org_path, self.group_name)):
-                t = parts[1].split("/")[-1]
-                self.topics[t] = {}
-                if verbose: print "Discovered %s" % parts[1]
-            elif len(parts) > 1 and parts[1].startswith("https://groups.google.com%s/forum/?_escaped_fragment_=forum/" % self.org_path):
-                next_page = parts[1]
-                if verbose: print "Next page is %s" % parts[1]
-        return next_page
+        topics = []
+        for link in links:
+            m = self.topic_link.match(link)
+            if m:
+                t = m.group(1)
+                self.topics.setdefault(t, {})
+                topics.append(t)
+                if link in last_posts:
+                    self.last_posts[t] = last_posts[link]
+                if verbose: print "Discovered %s" % link
+            elif self.next_page_link.match(link):
+                next_page = link
+                if verbose: print "Next page is %s" % link
+        return next_page, topics
+
+    def _run_parallel(self, function, items):
+        if self.scheduler:
+            self.scheduler.map(self.group_name, function, items)
+        else:
+            run_parallel(function, items, self.jobs)
+
+    def interrupted(self):
+        '''The shared scheduler was stopped, or abort was called: no new work should be started'''
+        return self.aborted or self.scheduler is not None and self.scheduler.aborted
+
+    def abort(self):
+        '''Stop the crawl from another thread, running requests are finished'''
+        self.aborted = True
 
     def fetch_messages(self):
         global verbose
         if verbose: print "Fetching messages ..."
-        for topic in self.topics.keys():
-            self.fetch_messages_topic(topic)
+        self._run_parallel(self.fetch_messages_topic, [(topic,) for topic in self.topics.keys()])
 
     def fetch_messages_topic(self, topic):
         global verbose
-        next_page = "https://groups.google.com%s/forum/?_escaped_fragment_=topic/%s/%s" % (self.org_path, self.group_name, topic)
+        next_page = "%s/forum/?_escaped_fragment_=topic/%s/%s" % (self.base_url, self.group_name, topic)
+        if self.journal and topic in self.journal.listings:
+            if verbose: print "Skipping %s, done in previous run" % next_page
+            for m in self.journal.listings[topic]:
+                self.topics[topic].setdefault(m, None)
+            return
+
+        # If all messages of the listing as it was last time have been retrieved, and the
+        # topic looks unchanged, there is nothing to do
+        known = self.manifest.topics.get(topic, {}) if self.manifest else None
+        fingerprint = self.fingerprints.get(topic) if self.fingerprints else None
+        request_headers = {}
+        if fingerprint and known and TopicFingerprints.messages_hash(known) == fingerprint.messages_hash:
+            if fingerprint.last_post and self.last_posts.get(topic) == fingerprint.last_post:
+                if verbose: print "Skipping %s, no new posts" % next_page
+                self._add_known_messages(topic, known)
+                return
+            if fingerprint.etag:
+                request_headers["If-None-Match"] = fingerprint.etag
+            if fingerprint.last_modified:
+                request_headers["If-Modified-Since"] = fingerprint.last_modified
+
         if verbose: print "Fetching %s" % next_page
-        header, data = self._fetch_x(next_page, list_only=True)
+        header, links, _ = self._fetch_links(next_page, request_headers)
+        if header.code == 304:
+            if verbose: print "Skipping %s, not modified" % next_page
+            self._add_known_messages(topic, known)
+            return
         if header.code != 200:
             print >>sys.stderr, "Error: %s: %s" % (next_page, header.status_line)
             return
 
-        for line in data.splitlines():
-            parts = line.split()
-            if len(parts) > 1 and parts[1].startswith("https://groups.google.com%s/d/msg/%s/%s" % (self.org_path, self.group_name, topic)):
-                m = parts[1].split("/")[-1]
-                self.topics[topic][m] = None
-                if verbose: print "Discovered %s" % parts[1]
+        messages = []
+        for link in links:
+            match = self.message_link.match(link)
+            if match and match.group(1) == topic:
+                m = match.group(2)
+                self.topics[topic].setdefault(m, None)
+                messages.append(m)
+                if verbose: print "Discovered %s" % link
+
+        if self.journal:
+            self.journal.listing_done(topic, messages)
+        if self.fingerprints:
+            self.fingerprints.set(topic, TopicFingerprint(TopicFingerprints.messages_hash(messages),
+                self.last_posts.get(topic), header.get("ETag"), header.get("Last-Modified")))
+
+    def _add_known_messages(self, topic, messages):
+        for m in messages:
+            self.topics[topic].setdefault(m, MessageRecord.KNOWN)
 
     def fetch_content(self):
         global verbose
+        if verbose: print "Retrieving message contents ..."
+        work = []
         for topic in self.topics.keys():
-            if verbose: print "Retrieving message contents for topic %s ..." % topic
             for message in self.topics[topic].keys():
-                message_url = "https://groups.google.com%s/forum/message/raw?msg=%s/%s/%s"  % (self.org_path, self.group_name, topic, message)
-                if self.topics[topic][message] is None:
-                    if verbose: print "Fetching %s" % message_url
-                    try:
-                        header, data = self._fetch_x(message_url, source=True)
-                        if header.code == 200:
-                            self.topics[topic][message] = data
+                work.append( (topic, message) )
+        self._run_parallel(self.fetch_message, work)
+
+    def fetch_message(self, topic, message):
+        global verbose
+        message_url = "%s/forum/message/raw?msg=%s/%s/%s"  % (self.base_url, self.group_name, topic, message)
+        if self.topics[topic][message] is None and (self.journal and (topic, message) in self.journal.messages
+                or self.is_stored(topic, message)):
+            if verbose: print "Skipping %s, already retrieved" % message_url
+            self.topics[topic][message] = MessageRecord.KNOWN
+            if self.dead_letters:
+                self.dead_letters.discard(message_url)
+        elif self.topics[topic][message] is None and not self.interrupted():
+            if verbose: print "Fetching %s" % message_url
+            try:
+                # Written to disk as it is received, never held in memory as a whole
+                with self.temp_file() as body:
+                    header, data = self._fetch_x(message_url, source=True, destination=body)
+                    if header.code == 200:
+                        self.store_message(topic, message, data)
+                        if self.journal:
+                            self.journal.message_done(topic, message)
+                        if self.dead_letters:
+                            self.dead_letters.discard(message_url)
+                    else:
+                        self.topics[topic][message] = MessageRecord(MessageRecord.FAILED)
+                        if self.dead_letters:
+                            self.dead_letters.add(message_url)
+                        if verbose:
+                            print "Error: %s: %s" % (message_url, header.status_line)
                         else:
-                            if verbose:
-                                print "Error: %s: %s" % (message_url, header.status_line)
-                            else:
-                                print >>sys.stderr, "%s/%s/%s: Failed (%s)" % (self.group_name, topic, message, header.code)
-                    except Exception as e:
-                        print >>sys.stderr, "%s: %s" % (message_url, e)
-                else:
-                    if verbose: "Skipping %s " % message_url
+                            print >>sys.stderr, "%s/%s/%s: Failed (%s)" % (self.group_name, topic, message, header.code)
+            except Exception as e:
+                if self.dead_letters:
+                    self.dead_letters.add(message_url)
+                print >>sys.stderr, "%s: %s" % (message_url, e)
+        else:
+            if verbose: print "Skipping %s " % message_url
+
+    # Kinds of pages, for the statistics: the first one whose marker is in the URL
+    URL_KINDS = (
+        ("_escaped_fragment_=forum/", "topic_page"),
+        ("_escaped_fragment_=topic/", "topic_listing"),
+        ("/forum/message/raw?", "raw_message"),
+        ("/msgs/rss.xml", "rss"),
+    )
+
+    def url_kind(self, url):
+        for marker, kind in self.URL_KINDS:
+            if marker in url:
+                return kind
+        return "other"
 
     def _fetch_x(self, url, list_only=False, *args, **kwargs):
-        if list_only:
+        global verbose
+        kind = self.url_kind(url)
+        attempt = 0
+        while True:
+            attempt += 1
+            destination = kwargs.get("destination")
+            if destination is not None:
+                # Left over from an earlier attempt
+                destination.seek(0)
+                destination.truncate()
+            try:
+                with self.limiter:
+                    started = time.time()
+                    header, data = self._fetch_x_unlimited(url, list_only, *args, **kwargs)
+            except (httplib.HTTPException, socket.error) as e:
+                self.stats.request(kind, time.time() - started, "error")
+                if not self.retry_policy.should_retry(attempt):
+                    self.limiter.report(False)
+                    raise
+                error = str(e)
+            else:
+                # Parsers (see _fetch_links) know how much they were fed, and how long that took
+                if hasattr(data, "parse_time"):
+                    self.stats.request(kind, time.time() - started - data.parse_time, header.code, data.size)
+                    self.stats.add_time("parse_%s" % kind, data.parse_time)
+                else:
+                    self.stats.request(kind, time.time() - started, header.code, len(data) if destination is None else destination.tell())
+                retry = header.code in RetryPolicy.RETRY_CODES and not header.code in RetryPolicy.FINAL_CODES.get(kind, ())
+                if not retry or not self.retry_policy.should_retry(attempt):
+                    self.limiter.report(not retry)
+                    break
+                error = header.status_line
+
+            self.stats.retry(kind)
+            delay = self.retry_policy.delay(attempt)
+            if verbose: print "Error: %s: %s, retrying in %.1fs" % (url, error, delay)
+            time.sleep(delay)
+
+        if header.code == 500:
+            self.had_500 = True
+        elif header.code == 403:
+            self.had_403 = True
+        return header, data
+
+    def _fetch_x_unlimited(self, url, list_only=False, *args, **kwargs):
+        if list_only and not self.fetcher.reports_status:
             data, stderr = self.fetcher.fetch(url, list_only=list_only, stderr=True, *args, **kwargs)
             header = None
             if len(stderr.strip()) > 0:
@@ -240,87 +1344,320 @@ class GroupInformation(object):
             if header is None:
                 header = HTTPHeader("HTTP/1.0 200 Probably OK. I Guess.")
         else:
-            header, data = self.fetcher.fetch(url, header=True, *args, **kwargs)
+            header, data = self.fetcher.fetch(url, list_only=list_only, header=True, *args, **kwargs)
             header = HTTPHeader(header)
 
-        if header.code == 500:
-            self.had_500 = True
-        elif header.code == 403:
-            self.had_403 = True
         return header, data
 
-    def write_tree(self, demangle=False):
+    def is_stored(self, topic, message):
+        if self.manifest:
+            return self.manifest.contains(topic, message)
+        if not isinstance(self.store, TreeStore):
+            # Nothing is kept, see iter_messages
+            return False
+        return os.path.exists(os.path.join(self.group_name, topic, message))
+
+    def is_known(self, topic, message):
+        '''The message has been retrieved in an earlier run, or found in this one. Update
+        mode doesn't read all known messages into self.topics, the manifest has them.'''
+        return message in self.topics.get(topic, ()) or self.is_stored(topic, message)
+
+    def temp_file(self):
+        '''Temporary file for a message, in temp_dir'''
+        return tempfile.TemporaryFile(dir=self.temp_dir)
+
+    def store_message(self, topic, message, data):
+        '''Demangle (if configured) and write a message to disk right away, only a
+        MessageRecord is kept in memory afterwards. data is a string, or a file that is
+        mapped instead of read into memory.'''
         global verbose
+        file_name = os.path.join(self.group_name, topic, message)
+        if self.is_stored(topic, message):
+            if verbose: print "Skipping %s, exists" % file_name
+            self.topics[topic][message] = MessageRecord.KNOWN
+            return
+
+        mapped = []
+        if isinstance(data, file):
+            data = map_file(data)
+            mapped.append(data)
+        try:
+            if self.demangle:
+                try:
+                    with self.stats.timer("demangle"):
+                        data = self._demangle(data, mapped)
+                except ProcessingError as e:
+                    print >>sys.stderr, "%s: %s" % (file_name, e.message)
+
+            if verbose: print "Writing message %s" % file_name
+            with self.stats.timer("write"):
+                location = self.store.write(topic, message, data)
+                if self.manifest:
+                    self.manifest.add(topic, message, data, location=location)
+            size = len(data)
+        finally:
+            for m in mapped:
+                # Empty files aren't mapped, see map_file
+                if isinstance(m, mmap.mmap):
+                    m.close()
+        self.stats.written(size)
+        if not self.quiet:
+            print self.store.describe(topic, message, location)
+        self.topics[topic][message] = MessageRecord(MessageRecord.WRITTEN, size)
+
+    def _demangle(self, data, mapped):
+        '''Demangled data. A mapped file is demangled into another temporary file, which
+        is mapped and added to mapped.'''
+        if isinstance(data, str):
+            return handle_data(data)
+        pieces = demangle_pieces(data)
+        if pieces == [(0, len(data))]:
+            return data
+        with self.temp_file() as fp:
+            write_pieces(fp, data, pieces)
+            result = map_file(fp)
+        mapped.append(result)
+        return result
+
+    def write_tree(self, demangle=None):
+        '''Write all message contents that are still held in memory. Messages retrieved
+        by fetch_content have already been written by store_message.'''
+        global verbose
+        if demangle is not None:
+            self.demangle = demangle
         for topic in self.topics.keys():
             if verbose: print "Writing message contents for topic %s ..." % topic
             for message in self.topics[topic].keys():
-                if self.topics[topic][message]:
-                    file_name = os.path.join(self.group_name, topic, message)
-                    if not os.path.exists(file_name):
-                        if verbose: print "Writing message %s" % file_name
-                        dir_name = os.path.join(self.group_name, topic)
-                        if not os.path.exists(dir_name):
-                            os.makedirs(dir_name)
-
-                        data = self.topics[topic][message]
-                        if demangle:
-                            try:
-                                data = handle_data(data)
-                            except ProcessingError as e:
-                                print >>sys.stderr, "%s: %s" % (file_name, e.message)
-
-                        with open(file_name, "w") as fp:
-                            fp.write(data)
-                            print file_name
-                    else:
-                        if verbose: print "Skipping %s, exists" % file_name
+                if isinstance(self.topics[topic][message], str):
+                    self.store_message(topic, message, self.topics[topic][message])
 
     def read_tree(self, read_contents = True):
+        if self.manifest:
+            if read_contents:
+                for topic, message, entry in self.manifest.entries():
+                    self.topics.setdefault(topic, {})[message] = self.store.read(topic, message, entry[3])
+            else:
+                # Shares the message IDs with the manifest, and one record for all
+                for topic, messages in self.manifest.topics.iteritems():
+                    self.topics[topic] = dict.fromkeys(messages, MessageRecord.KNOWN)
+            return
+
         for topic in os.listdir(self.group_name):
             self.topics[topic] = {}
             for message in os.listdir( os.path.join(self.group_name, topic) ):
+                if message.startswith("."):
+                    continue
                 if read_contents:
-                    self.topics[topic][message] = open( os.path.join(self.group_name, topic, message, "r") ).read()
+                    self.topics[topic][message] = open( os.path.join(self.group_name, topic, message), "r" ).read()
                 else:
-                    self.topics[topic][message] = None
+                    self.topics[topic][message] = MessageRecord.KNOWN
 
-    def fetch_update(self, update_count, replace_information=False):
+    def fetch_failed(self):
+        '''Retry the messages in the dead letter list'''
         global verbose
-        if verbose: print "Retrieving update RSS ..."
-        rss_url = "https://groups.google.com%s/forum/feed/%s/msgs/rss.xml?num=%i" % (self.org_path, self.group_name, update_count)
-        header, data = self._fetch_x(rss_url, source=True)
-        if header.code != 200:
-            print >>sys.stderr, "Error: %s: %s" % (rss_url, header.status_line)
-            return
-
-        root = ElementTree.fromstring(data)
+        for url in sorted(self.dead_letters.urls):
+            topic, message = url.rsplit("=", 1)[1].split("/")[-2:]
+            if verbose: print "Retrying %s, %s" % (topic, message)
+            self.topics.setdefault(topic, {})[message] = None
+        self.fetch_content()
 
-        topics = {}
+    def fetch_update(self, update_count, replace_information=False, max_update_count=None, catch_up_pages=0):
+        '''Retrieve the messages in the RSS feed of the last update_count messages.
 
-        nodes = root.findall(".//item/link")
-        for node in nodes:
-            url = node.text
-            if url.startswith("https://groups.google.com%s/d/msg/%s" % (self.org_path, self.group_name)):
-                topic, message = url.split("/")[-2:]
+        If all of them are new, there may be more new messages than that. The feed is then
+        requested again, with four times as many messages each time up to max_update_count,
+        until it reaches known messages. If it doesn't, up to catch_up_pages topic pages are
+        checked for new messages, until a page with an unchanged topic.'''
+        global verbose
+        count = update_count
+        # New messages found in the feed so far, they are still new in a larger feed
+        found = set()
+        while True:
+            links = self.fetch_feed(count)
+            if links is None:
+                return
+            messages = []
+            for link in links:
+                m = self.message_link.match(link)
+                if m:
+                    messages.append( (m.group(1), m.group(2)) )
+            new = [ (topic, message) for topic, message in messages if (topic, message) in found or not self.is_known(topic, message) ]
+            if verbose: print "%i messages in feed, %i new" % (len(messages), len(new))
+            for topic, message in new:
+                if (topic, message) in found:
+                    continue
                 if verbose: print "Discovered %s, %s" % (topic, message)
-
-                if not topic in self.topics:
-                    if verbose: print "Topic %s is new" % topic
-                    self.topics[topic] = {}
-                    topics[topic] = {}
-
-                if not message in self.topics[topic]:
-                    if verbose: print "Message %s is new" % message
-                    self.topics[topic][message] = None
-
-                    if not topic in topics: topics[topic] = {}
-                    topics[topic][message] = None
+                found.add( (topic, message) )
+                self.topics.setdefault(topic, {})[message] = None
+
+            # A feed with fewer messages than requested has all messages of the group
+            gap = messages and len(new) == len(messages) and len(links) >= count
+            if not gap or not max_update_count or count >= max_update_count:
+                break
+            count = min(count * 4, max_update_count)
+            if verbose: print "All messages in feed are new, requesting %i messages" % count
+
+        if gap:
+            if catch_up_pages:
+                self.catch_up(catch_up_pages)
+            else:
+                print >>sys.stderr, "All %i messages in the feed are new, some messages may be missing. Use --max-update-count or a full crawl." % len(messages)
 
         if replace_information:
+            # Keep only the new messages
+            topics = {}
+            for topic, contents in self.topics.iteritems():
+                new_messages = dict( (m, None) for m, content in contents.iteritems() if content is None )
+                if new_messages:
+                    topics[topic] = new_messages
             self.topics = topics
 
         self.fetch_content()
 
+    def fetch_feed(self, count):
+        '''Retrieve the RSS feed of the last count messages, returns the item links or None'''
+        global verbose
+        if verbose: print "Retrieving update RSS ..."
+        rss_url = "%s/forum/feed/%s/msgs/rss.xml?num=%i" % (self.base_url, self.group_name, count)
+        if self.fetcher.reports_status:
+            header, feed = self._fetch_x(rss_url, parser=FeedLinks)
+        else:
+            header, data = self._fetch_x(rss_url, source=True)
+            feed = FeedLinks(rss_url)
+            feed.feed(data)
+            feed.close()
+        if header.code != 200:
+            print >>sys.stderr, "Error: %s: %s" % (rss_url, header.status_line)
+            return None
+        if feed.error:
+            print >>sys.stderr, "Error: %s: %s" % (rss_url, feed.error)
+            return None
+        return feed.links
+
+    def catch_up(self, page_limit):
+        '''Look for new messages on the first page_limit topic pages. The topic pages show
+        the most recently active topics first, stops after the first page with a topic that
+        has no new messages.'''
+        global verbose
+        if verbose: print "Checking up to %i topic pages for new messages ..." % page_limit
+
+        def list_topics(topics):
+            unchanged = []
+            def list_topic(topic):
+                self.fetch_messages_topic(topic)
+                # Messages found in the feed are new, but were already added
+                if self.topics[topic] and not [ m for m, content in self.topics[topic].iteritems()
+                        if content is None and not self.is_stored(topic, m) ]:
+                    unchanged.append(topic)
+            self._run_parallel(list_topic, [(t,) for t in topics])
+            if unchanged and verbose: print "Topic %s has no new messages, stopping" % unchanged[0]
+            return bool(unchanged)
+
+        self.fetch_topics(page_limit, list_topics)
+
+    # Seconds between looks at the queue of a distributed crawl, when there is nothing to do
+    QUEUE_POLL_INTERVAL = 5
+
+    def coordinate(self, queue, page_limit=None):
+        '''Coordinator of a distributed crawl: put the topics on the topic pages into queue,
+        most recently active first, and wait until the workers (see work) are done'''
+        global verbose
+        queue.set("format", self.store.name)
+        queue.set("discovery", "running")
+        complete = self.fetch_topics(page_limit, lambda topics: queue.add([ (t, self.last_posts.get(t)) for t in topics ]))
+        # Also if not all topic pages could be read, the workers finish the topics found so far
+        queue.set("discovery", "done")
+        self._finish_crawl(complete)
+
+        while not queue.finished():
+            if verbose: print "Topics: %s" % ", ".join("%i %s" % (n, state) for state, n in sorted(queue.counts().items()))
+            time.sleep(self.QUEUE_POLL_INTERVAL)
+        counts = queue.counts()
+        if verbose: print "Retrieved %i topics" % counts.get("done", 0)
+        if counts.get("failed"):
+            print >>sys.stderr, "%i topics could not be retrieved" % counts["failed"]
+
+        # The workers appended to the manifest and the list of failed messages, drop the
+        # messages from that list that have been retrieved by another worker after all
+        self.manifest.load()
+        self.dead_letters.load()
+        for url in list(self.dead_letters.urls):
+            topic, message = url.rsplit("=", 1)[1].split("/")[-2:]
+            if self.manifest.contains(topic, message):
+                self.dead_letters.discard(url)
+        # and are done with it, it can be rewritten
+        self.dead_letters.shared = False
+        if complete:
+            queue.remove()
+
+    def work(self, queue, worker, lease_time):
+        '''Worker of a distributed crawl: claim topics from queue (see coordinate), list them
+        and retrieve their messages, with self.jobs topics at the same time, until the queue is
+        finished. Leases are renewed while the topics are worked on.'''
+        global verbose
+        held = set()
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(lease_time / 3.0):
+                queue.renew(worker, list(held), lease_time)
+
+        def work_topics():
+            while not stop.is_set():
+                claimed = queue.claim(worker, lease_time)
+                if claimed is None:
+                    if queue.finished():
+                        return
+                    stop.wait(self.QUEUE_POLL_INTERVAL)
+                    continue
+                topic, last_post, claims = claimed
+                if verbose: print "Claimed topic %s" % topic
+                held.add(topic)
+                try:
+                    if claims > 1:
+                        # A worker gave up on it, or died: see what it has retrieved
+                        self.manifest.load()
+                    self.topics.setdefault(topic, {})
+                    if last_post:
+                        self.last_posts[topic] = last_post
+                    self.fetch_messages_topic(topic)
+                    for message, content in self.topics[topic].items():
+                        if stop.is_set():
+                            break
+                        if content is None:
+                            self.fetch_message(topic, message)
+                except Exception as e:
+                    print >>sys.stderr, "%s: %s" % (topic, e)
+                    queue.release(worker, topic)
+                else:
+                    if stop.is_set():
+                        queue.release(worker, topic)
+                    else:
+                        queue.done(worker, topic)
+                finally:
+                    held.discard(topic)
+                    # Only the queue needs to know about finished topics
+                    self.topics.pop(topic, None)
+                    self.last_posts.pop(topic, None)
+
+        threads = [ threading.Thread(target=work_topics) for _ in range(self.jobs) ]
+        renewer = threading.Thread(target=heartbeat)
+        renewer.daemon = True
+        renewer.start()
+        for t in threads:
+            t.daemon = True
+            t.start()
+        try:
+            _join_all(threads)
+        except KeyboardInterrupt:
+            print >>sys.stderr, "Interrupted, waiting for running requests to finish ..."
+            stop.set()
+            _join_all(threads)
+            raise
+        finally:
+            stop.set()
+            _join_all([renewer])
+
     def login(self):
         print """Please log in to your Google groups account (navigate the form fields with up
 and down arrows, submit form with Enter) and then exit the browser (using the 'q' key).
@@ -339,6 +1676,254 @@ class CLIError(Exception):
     def __unicode__(self):
         return self.msg
 
+def rebuild_manifest(manifest, store):
+    global verbose
+    topic_count = manifest.rebuild(store)
+    if verbose: print "Rebuilt %s with %i topics" % (manifest.file_name, topic_count)
+
+def open_store(group, store_format=None, blob_dir=None):
+    store_format = store_format or detect_format(group)
+    if blob_dir is None:
+        return STORES[store_format](group)
+    if store_format != TreeStore.name:
+        raise CLIError("%s: a blob directory can only be used with the %s format" % (group, TreeStore.name))
+    return TreeStore(group, blob_dir)
+
+def open_group(fetcher, group, organization=None, store_format=None, blob_dir=None, crawl=False, recheck_topics=False, shared=False, **kwargs):
+    '''GroupInformation for group, with the files kept next to the group directory. Other
+    keyword arguments are passed on to GroupInformation. In a distributed crawl (shared),
+    other processes write to the files at the same time.'''
+    store = open_store(group, store_format, blob_dir)
+
+    # Index of retrieved messages, created from the store on first use
+    manifest = ArchiveManifest("%s.manifest" % group, shared=shared)
+    if not manifest.exists():
+        rebuild_manifest(manifest, store)
+
+    # A full crawl records its progress next to the group directory, to be able to resume it
+    journal = CrawlJournal("%s.journal" % group) if crawl else None
+    # and remembers what the topic listings looked like, to skip unchanged topics next time
+    fingerprints = TopicFingerprints("%s.topics" % group, use_existing=not recheck_topics, shared=shared) if crawl or shared else None
+    # Messages that couldn't be retrieved, to retry them with --retry-failed
+    dead_letters = DeadLetters("%s.failed" % group, shared=shared)
+    return GroupInformation(fetcher, group, organization, journal=journal, manifest=manifest,
+        fingerprints=fingerprints, dead_letters=dead_letters, store=store, **kwargs)
+
+class QueueStore(object):
+    '''Store that hands the messages to a consumer through queue instead of writing
+    them, see iter_messages. write blocks while queue is full.'''
+    name = "queue"
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def write(self, topic, message, data):
+        # A copy, a mapped file is closed when this returns
+        self.queue.put( (topic, message, data[:]) )
+        return None
+
+    def describe(self, topic, message, location=None):
+        return "%s/%s" % (topic, message)
+
+def iter_messages(group, since=None, organization=None, fetcher=None, jobs=4, demangle=False, base_url=None, buffer_size=100, temp_dir=None):
+    '''Retrieve all messages of group and yield (topic, message, raw message) for each as
+    soon as it has been retrieved. Nothing is kept on disk, messages only pass through
+    temporary files while they are received.
+
+    The crawl runs in jobs threads while the caller works on the messages, and waits
+    while buffer_size messages haven't been taken yet. since (seconds since the epoch,
+    or a datetime in UTC) leaves out messages with an earlier Date header, all topics
+    are still listed. fetcher is an HTTPFetcher by default, use e.g.
+    HTTPFetcher(lynx_cookie_file=...) for a private group. The temporary files are
+    created in temp_dir, the usual directory for temporary files by default.'''
+    if since is not None and hasattr(since, "utctimetuple"):
+        since = calendar.timegm(since.utctimetuple())
+    messages = Queue.Queue(buffer_size)
+    group_information = GroupInformation(fetcher or HTTPFetcher(), group, organization, jobs=jobs, demangle=demangle,
+        store=QueueStore(messages), base_url=base_url, quiet=True, temp_dir=temp_dir or tempfile.gettempdir())
+    done = object()
+    error = []
+
+    def crawl():
+        try:
+            group_information.fetch()
+        except Exception:
+            error.append(sys.exc_info())
+        finally:
+            messages.put(done)
+
+    crawler = threading.Thread(target=crawl)
+    crawler.daemon = True
+    crawler.start()
+    try:
+        while True:
+            item = messages.get()
+            if item is done:
+                break
+            if since is not None:
+                date = index.parse_date(parse_headers(item[2])["Date"])
+                if date is not None and date < since:
+                    continue
+            yield item
+    finally:
+        # The caller may stop early: let running downloads finish into the queue, and drop them
+        group_information.abort()
+        while crawler.is_alive():
+            try:
+                messages.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+    if error:
+        raise error[0][0], error[0][1], error[0][2]
+
+def wait_for_queue(group):
+    '''The queue of the distributed crawl of group, once its coordinator has started'''
+    global verbose
+    file_name = "%s.queue" % group
+    waiting = False
+    while True:
+        if os.path.exists(file_name):
+            queue = TopicQueue(file_name)
+            if queue.get("format"):
+                return queue
+        if verbose and not waiting: print "Waiting for the coordinator of %s ..." % group
+        waiting = True
+        time.sleep(GroupInformation.QUEUE_POLL_INTERVAL)
+
+def report_problems(group_information):
+    global batch_mode
+    if batch_mode:
+        return
+    if group_information.had_500:
+        print >>sys.stderr, "Some messages could not be retrieved due to a HTTP '500' error. This may mean that the messages have been deleted. See documentation."
+    if group_information.had_403:
+        print >>sys.stderr, "Some resources could not be retrieved due to a HTTP '403' error (Unauthorized access). You may want to retry with -l. See documentation."
+    dead_letters = group_information.dead_letters
+    if dead_letters.urls:
+        print >>sys.stderr, "%i messages could not be retrieved, they are listed in %s. Use --retry-failed to try them again." % (len(dead_letters.urls), dead_letters.file_name)
+
+DaemonGroup = collections.namedtuple("DaemonGroup", "name organization fetcher lynx_cfg cookie_file interval update_count max_update_count catch_up_pages demangle format blob_dir")
+
+DAEMON_DEFAULTS = {
+    "organization": "",
+    "fetcher": "http",
+    "lynx-cfg": "~/.lynxrc",
+    "cookie-file": "",
+    "interval": "3600",
+    "update-count": "50",
+    "max-update-count": "500",
+    "catch-up-pages": "10",
+    "demangle": "no",
+    "format": "",
+    "blob-dir": "",
+}
+
+def read_daemon_config(config_file):
+    '''Read the groups for daemon mode, one section per group'''
+    config = ConfigParser.RawConfigParser(DAEMON_DEFAULTS)
+    if not config.read(config_file):
+        raise CLIError("%s: can't read configuration file" % config_file)
+
+    groups = []
+    for name in config.sections():
+        group = DaemonGroup(name=name,
+            organization=config.get(name, "organization") or None,
+            fetcher=config.get(name, "fetcher"),
+            lynx_cfg=expanduser(config.get(name, "lynx-cfg")) or None,
+            cookie_file=os.path.abspath(expanduser(config.get(name, "cookie-file"))) if config.get(name, "cookie-file") else None,
+            interval=config.getint(name, "interval"),
+            update_count=config.getint(name, "update-count"),
+            max_update_count=config.getint(name, "max-update-count"),
+            catch_up_pages=config.getint(name, "catch-up-pages"),
+            demangle=config.getboolean(name, "demangle"),
+            format=config.get(name, "format") or None,
+            blob_dir=os.path.abspath(expanduser(config.get(name, "blob-dir"))) if config.get(name, "blob-dir") else None)
+        if not group.fetcher in FETCHERS:
+            raise CLIError("%s: fetcher must be one of %s" % (name, ", ".join(sorted(FETCHERS.keys()))))
+        if group.format and not group.format in STORES:
+            raise CLIError("%s: format must be one of %s" % (name, ", ".join(sorted(STORES.keys()))))
+        if group.lynx_cfg and not os.path.exists(group.lynx_cfg):
+            group = group._replace(lynx_cfg=None)
+        groups.append(group)
+    return groups
+
+def poll_group(group, fetcher, scheduler, limiter, retry_policy, stats=None):
+    '''Update group from its RSS, or crawl it if that hasn't been completed yet'''
+    global verbose
+    # The journal is only removed when a crawl is complete, it is still there if the
+    # last crawl was stopped or couldn't retrieve all topic pages
+    unfinished = os.path.exists("%s.journal" % group.name)
+    crawl = unfinished or not os.path.exists("%s.manifest" % group.name)
+    group_information = open_group(fetcher, group.name, group.organization, store_format=group.format, blob_dir=group.blob_dir, crawl=crawl,
+        scheduler=scheduler, limiter=limiter, demangle=group.demangle, retry_policy=retry_policy, stats=stats)
+    try:
+        if crawl:
+            if verbose: print "%s: %s" % (group.name, "continuing the crawl" if unfinished else "crawling")
+            group_information.fetch()
+        else:
+            if verbose: print "%s: updating" % group.name
+            group_information.fetch_update(group.update_count, replace_information=True,
+                max_update_count=group.max_update_count, catch_up_pages=group.catch_up_pages)
+    finally:
+        group_information.dead_letters.close()
+        if stats:
+            stats.save()
+    report_problems(group_information)
+
+def run_daemon(groups, jobs=1, max_rate=None, max_in_flight=None, retries=3, retry_budget=1000, stats=None):
+    '''Serve all groups in one process, until interrupted: each group is updated from its
+    RSS every interval seconds (and crawled first, if that hasn't been done yet). All groups
+    share the request threads, which take turns between the groups, the connections and
+    the rate limit. The statistics are saved after each update of a group.'''
+    global verbose
+    scheduler = FairScheduler(jobs)
+    limiter = RateLimiter(max_rate, max_in_flight or jobs)
+    stop = threading.Event()
+
+    # Groups with the same cookie configuration share a fetcher
+    fetchers = {}
+    has_cookies = {}
+    for group in groups:
+        key = (group.fetcher, group.lynx_cfg, group.cookie_file)
+        if not key in fetchers:
+            fetchers[key] = FETCHERS[group.fetcher](group.lynx_cfg, group.cookie_file)
+            has_cookies[key] = fetchers[key].has_cookies()
+        if verbose and not has_cookies[key]:
+            print "Note: No cookie file available for %s, cannot act as logged-in user. See documentation." % group.name
+
+    def serve(group, fetcher):
+        while not stop.is_set():
+            started = time.time()
+            try:
+                poll_group(group, fetcher, scheduler, limiter, RetryPolicy(retries, retry_budget), stats)
+            except Exception as e:
+                print >>sys.stderr, "%s: %s" % (group.name, e)
+            if verbose: print "%s: next update in %is" % (group.name, max(0, group.interval - (time.time() - started)))
+            stop.wait(max(0, group.interval - (time.time() - started)))
+
+    with nested(*[f.temp_context() for f in fetchers.values()]):
+        threads = []
+        for group in groups:
+            t = threading.Thread(target=serve, args=(group, fetchers[(group.fetcher, group.lynx_cfg, group.cookie_file)]))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        try:
+            _join_all(threads)
+        except KeyboardInterrupt:
+            print >>sys.stderr, "Interrupted, waiting for running requests to finish ..."
+            stop.set()
+            scheduler.abort()
+            _join_all(threads)
+            raise
+
+# gggd COMMAND ... runs these instead of retrieving a group
+COMMANDS = {
+    "index": index.main,
+    "export": export.main,
+    "verify": verify.main,
+}
+
 def main(argv=None): # IGNORE:C0111
     '''Command line options.'''
     global verbose, batch_mode
@@ -348,6 +1933,9 @@ def main(argv=None): # IGNORE:C0111
     else:
         sys.argv.extend(argv)
 
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        return COMMANDS[sys.argv[1]](sys.argv[2:])
+
     program_name = os.path.basename(sys.argv[0])
     program_version = "v%s" % __version__
     program_build_date = str(__updated__)
@@ -374,17 +1962,43 @@ USAGE
         parser.add_argument("-t", "--topic-page-limit", help="Number of topic overview pages to process, usually at 20 topics per page", default=None, type=int)
         parser.add_argument("-c", "--lynx-cfg", help="Lynx configuration file [default: %(default)s]", default=expanduser("~/.lynxrc"))
         parser.add_argument("-C", "--lynx-cookie-file", help="Lynx cookie file to read cookies from and store cookies to")
+        parser.add_argument("-F", "--fetcher", choices=sorted(FETCHERS.keys()), default="http", help="How to retrieve pages: in-process HTTP with persistent connections, or one lynx process per request. lynx is always needed for --login [default: %(default)s]")
         parser.add_argument("-b", "--batch-mode", action="store_true", help="Batch mode: no interaction at all, no helpful hints")
         parser.add_argument("-l", "--login", action="store_true", help="Open the Google groups login form before performing other actions")
         parser.add_argument("-L", "--login-only", action="store_true", help="Exit after opening the Google groups login form (implies --login)")
         parser.add_argument("-u", "--update", help="Don't spider, but update from RSS of last messages", action="store_true")
         parser.add_argument("-U", "--update-count", help="Number of messages to request in RSS for --update mode, default: 50", default=None, type=int)
+        parser.add_argument("--max-update-count", help="When all messages in the RSS are new, request up to this many messages in the RSS [default: %(default)s]", default=500, type=int)
+        parser.add_argument("--catch-up-pages", help="When all messages in the RSS with --max-update-count messages are new, check up to this many topic pages for new messages [default: %(default)s]", default=10, type=int)
         parser.add_argument("-d", "--demangle", action="store_true", help="Demangle message contents before writing")
+        parser.add_argument("-j", "--jobs", help="Number of topic listings and messages to retrieve in parallel [default: %(default)s]", default=1, type=int)
+        parser.add_argument("--max-rate", help="Maximum number of requests per second, over all jobs [default: unlimited]", default=None, type=float)
+        parser.add_argument("--max-in-flight", help="Maximum number of requests in flight at the same time [default: number of jobs]", default=None, type=int)
+        parser.add_argument("--retries", help="Number of attempts for each request, when the server reports a temporary error [default: %(default)s]", default=3, type=int)
+        parser.add_argument("--retry-budget", help="Maximum number of retries during the whole run [default: %(default)s]", default=1000, type=int)
+        parser.add_argument("--retry-failed", action="store_true", help="Only retry the messages that could not be retrieved previously (listed in GROUP.failed)")
+        parser.add_argument("--recheck-topics", action="store_true", help="Retrieve the listings of all topics, even of those that look unchanged since the last crawl")
+        parser.add_argument("-f", "--format", choices=sorted(STORES.keys()), help="How to store messages: one file per message in GROUP/TOPIC/MESSAGE, one mbox file per topic in GROUP/TOPIC.mbox, or compressed segment files GROUP/segment-NNNNNN.gz [default: format of the existing group directory, else tree]")
+        parser.add_argument("--blob-dir", help="Store the content of each message once in this directory, named by its SHA-1, and make GROUP/TOPIC/MESSAGE a hardlink to it. Several groups can share the directory (tree format only)")
+        parser.add_argument("--rebuild-index", action="store_true", help="Regenerate the index of retrieved messages (GROUP.manifest) from the group directory and exit")
+        parser.add_argument("--coordinator", action="store_true", help="Distributed crawl: find the topics, put them into the queue GROUP.queue for --worker processes and wait until they are done")
+        parser.add_argument("--worker", action="store_true", help="Distributed crawl: list the topics in GROUP.queue and retrieve their messages, see --coordinator. Several workers, also on other hosts sharing the directory, can work on one group")
+        parser.add_argument("--lease", help="Seconds a --worker claims a topic for at a time. Topics of a worker that stopped are given to another worker after that [default: %(default)s]", default=300, type=int)
         parser.add_argument("-o", "--organization", help="Use only if the Google Group is nested under an organization, eg 'w3c.org'")
-        parser.add_argument(dest="group", help="Name of the Google Group to fetch", metavar="group")
+        parser.add_argument("--base-url", help="Address of Google Groups, e.g. of a local test server [default: %s]" % BASE_URL)
+        parser.add_argument("--stats", metavar="FILE", help="Write statistics of the run to FILE: latency, size and status of the requests, retries, time spent parsing, demangling and writing. In daemon mode FILE is updated after each update of a group")
+        parser.add_argument("--stats-format", choices=RunStatistics.FORMATS, default="json", help="Format of the --stats file: JSON, or the Prometheus text format [default: %(default)s]")
+        parser.add_argument("-D", "--daemon", metavar="CONFIG", help="Keep running and update all groups in the configuration file CONFIG, see documentation. Only -j, --max-rate, --max-in-flight, --retries, --retry-budget, -b and -v apply to all groups, other settings are in CONFIG")
+        parser.add_argument(dest="group", help="Name of the Google Group to fetch", metavar="group", nargs="?")
 
         # Process arguments
         args = parser.parse_args()
+        if not args.group and not args.daemon:
+            parser.error("a group name is required")
+        if (args.coordinator or args.worker) and (args.update or args.update_count is not None or args.retry_failed or args.daemon):
+            parser.error("--coordinator and --worker are for full crawls")
+        if args.coordinator and args.worker:
+            parser.error("a process can't be --coordinator and --worker at the same time")
         if args.update_count is None:
             args.update_count = 50
         else:
@@ -414,7 +2028,18 @@ USAGE
             if verbose: print "%s: does not exist, not using LYNX_CFG" % lynx_cfg
             lynx_cfg = None
 
-        fetcher = LynxFetcher(lynx_cfg, lynx_cookie_file)
+        stats = RunStatistics(args.stats, args.stats_format)
+
+        if args.daemon:
+            run_daemon(read_daemon_config(args.daemon), jobs=args.jobs, max_rate=args.max_rate, max_in_flight=args.max_in_flight,
+                retries=args.retries, retry_budget=args.retry_budget, stats=stats)
+            return 0
+
+        if args.rebuild_index:
+            rebuild_manifest(ArchiveManifest("%s.manifest" % group), open_store(group, args.format))
+            return 0
+
+        fetcher = FETCHERS[args.fetcher](lynx_cfg, lynx_cookie_file)
 
         if not fetcher.has_cookies():
             if args.login:
@@ -424,33 +2049,55 @@ USAGE
             else:
                 if verbose: print "Note: No cookie file available for lynx and/or cookie sending not enabled, cannot act as logged-in user. See documentation."
 
-        with fetcher.temp_context():
-            group_information = GroupInformation(fetcher, group, organization)
-
-            if args.login:
-                group_information.login()
+        store_format = args.format
+        if args.coordinator and (store_format or detect_format(group)) == "segments":
+            raise CLIError("%s: the segments format can't be written by several processes" % group)
+        queue = None
+        if args.worker:
+            # The coordinator decides the format
+            queue = wait_for_queue(group)
+            store_format = queue.get("format")
 
+        with fetcher.temp_context():
             if args.login_only:
+                # Nothing is retrieved, the group directory and its files aren't needed
+                GroupInformation(fetcher, group, organization, base_url=args.base_url).login()
                 return 0
 
-            if args.update:
-                group_information.read_tree(read_contents=False)
-                group_information.fetch_update(args.update_count, replace_information=True)
-            else:
-                group_information.fetch(args.topic_page_limit)
+            limiter = RateLimiter(args.max_rate, args.max_in_flight or args.jobs)
+            crawl = not args.update and not args.retry_failed and not args.worker
+            group_information = open_group(fetcher, group, organization, store_format=store_format, blob_dir=args.blob_dir, crawl=crawl,
+                recheck_topics=args.recheck_topics, shared=args.coordinator or args.worker, jobs=args.jobs, limiter=limiter,
+                demangle=args.demangle, retry_policy=RetryPolicy(args.retries, args.retry_budget), base_url=args.base_url, stats=stats)
+
+            if args.login:
+                group_information.login()
 
-            group_information.write_tree(demangle=args.demangle)
+            try:
+                if args.retry_failed:
+                    group_information.fetch_failed()
+                elif args.coordinator:
+                    group_information.coordinate(TopicQueue("%s.queue" % group), args.topic_page_limit)
+                elif args.worker:
+                    group_information.work(queue, "%s:%i" % (socket.gethostname(), os.getpid()), args.lease)
+                elif args.update:
+                    group_information.fetch_update(args.update_count, replace_information=True,
+                        max_update_count=args.max_update_count, catch_up_pages=args.catch_up_pages)
+                else:
+                    group_information.fetch(args.topic_page_limit)
+            finally:
+                group_information.dead_letters.close()
+                stats.save()
 
-            if not batch_mode:
-                if group_information.had_500:
-                    print >>sys.stderr, "Some messages could not be retrieved due to a HTTP '500' error. This may mean that the messages have been deleted. See documentation."
-                if group_information.had_403:
-                    print >>sys.stderr, "Some resources could not be retrieved due to a HTTP '403' error (Unauthorized access). You may want to retry with -l. See documentation."
+            report_problems(group_information)
 
         return 0
     except KeyboardInterrupt:
         ### handle keyboard interrupt ###
         return 0
+    except CLIError as e:
+        sys.stderr.write(program_name + ": " + str(e) + "\n")
+        return 2
     except Exception as e:
         if DEBUG or TESTRUN:
             raise
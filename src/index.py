@@ -0,0 +1,208 @@
+#!/usr/bin/env python2.7
+'''
+gggd index -- SQLite index of the headers of retrieved messages
+
+The index is kept in GROUP.index next to the group directory. Updating it only
+parses the messages that are new or changed according to GROUP.manifest.
+
+@author: henryk
+'''
+from argparse import ArgumentParser
+import sys
+import os
+import time
+import calendar
+import sqlite3
+import email.utils
+import email.header
+import email.errors
+
+from demangle import parse_headers
+from archive import ArchiveManifest, STORES, detect_format
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    topic TEXT NOT NULL,
+    message TEXT NOT NULL,
+    sha1 TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    message_id TEXT,
+    in_reply_to TEXT,
+    refs TEXT,
+    sender TEXT,
+    date INTEGER,
+    subject TEXT,
+    PRIMARY KEY (topic, message)
+);
+CREATE INDEX IF NOT EXISTS messages_message_id ON messages (message_id);
+CREATE INDEX IF NOT EXISTS messages_date ON messages (date);
+CREATE TABLE IF NOT EXISTS message_refs (
+    topic TEXT NOT NULL,
+    message TEXT NOT NULL,
+    ref TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS message_refs_ref ON message_refs (ref);
+CREATE INDEX IF NOT EXISTS message_refs_message ON message_refs (topic, message);
+"""
+
+def _decode(value):
+    '''Header value as unicode, with RFC 2047 encoded words decoded'''
+    if value is None:
+        return None
+    try:
+        return u" ".join( part.decode(charset or "ascii", "replace") for part, charset in email.header.decode_header(value) )
+    except (email.errors.HeaderParseError, LookupError):
+        return value.decode("ascii", "replace")
+
+def _message_ids(value):
+    '''The message IDs in a References or In-Reply-To header'''
+    if not value:
+        return []
+    return [ "<%s>" % i.split(">")[0] for i in value.split("<")[1:] if ">" in i ]
+
+def parse_date(value):
+    '''A Date header as seconds since the epoch, or None'''
+    parsed = email.utils.parsedate_tz(value) if value else None
+    return email.utils.mktime_tz(parsed) if parsed else None
+
+def header_fields(data):
+    '''Values for the index columns of a message'''
+    msg = parse_headers(data)
+    date = parse_date(msg["Date"])
+    in_reply_to = _message_ids(msg["In-Reply-To"])
+    refs = _message_ids(msg["References"])
+    message_id = _message_ids(msg["Message-ID"])
+    return dict(message_id=message_id[0] if message_id else None,
+        in_reply_to=in_reply_to[0] if in_reply_to else None,
+        refs=refs + [i for i in in_reply_to if not i in refs],
+        sender=_decode(msg["From"]), date=date, subject=_decode(msg["Subject"]))
+
+class MessageIndex(object):
+    '''The SQLite database with one row per message and one per reference'''
+    def __init__(self, file_name):
+        self.db = sqlite3.connect(file_name)
+        self.db.executescript(SCHEMA)
+
+    def update(self, manifest, store, verbose=False):
+        '''Parse the messages that are new or changed according to manifest, and drop the
+        ones that aren't in it anymore. Returns (number of added/changed, number of removed).'''
+        indexed = dict( ((topic, message), sha1) for topic, message, sha1 in
+            self.db.execute("SELECT topic, message, sha1 FROM messages") )
+        changed = 0
+        with self.db:
+            for topic, message, (size, sha1, fetch_time, location) in manifest.entries():
+                if indexed.pop( (topic, message), None ) == sha1:
+                    continue
+                if verbose: print "Indexing %s/%s" % (topic, message)
+                try:
+                    fields = header_fields(store.read(topic, message, location))
+                except (IOError, OSError) as e:
+                    print >>sys.stderr, "%s/%s: %s" % (topic, message, e)
+                    continue
+                self._delete(topic, message)
+                self.db.execute("INSERT INTO messages (topic, message, sha1, size, message_id, in_reply_to, refs, sender, date, subject) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (topic, message, sha1, size, fields["message_id"], fields["in_reply_to"],
+                    " ".join(fields["refs"]), fields["sender"], fields["date"], fields["subject"]))
+                self.db.executemany("INSERT INTO message_refs (topic, message, ref) VALUES (?, ?, ?)",
+                    [ (topic, message, ref) for ref in fields["refs"] ])
+                changed += 1
+            for topic, message in indexed:
+                self._delete(topic, message)
+        return changed, len(indexed)
+
+    def _delete(self, topic, message):
+        self.db.execute("DELETE FROM messages WHERE topic = ? AND message = ?", (topic, message))
+        self.db.execute("DELETE FROM message_refs WHERE topic = ? AND message = ?", (topic, message))
+
+    COLUMNS = "topic, message, date, sender, subject, message_id"
+
+    def find_id(self, message_id):
+        return self.db.execute("SELECT %s FROM messages WHERE message_id = ?" % self.COLUMNS, (message_id,)).fetchall()
+
+    def thread(self, message_id):
+        '''All messages of the thread of message_id: the ones in the same topic, and the ones
+        connected to it by References and In-Reply-To'''
+        found = set()
+        ids = set([message_id])
+        todo = [message_id]
+        while todo:
+            i = todo.pop()
+            rows = self.db.execute("SELECT m.topic, m.message, m.message_id, m.refs FROM messages m WHERE m.message_id = ? "
+                "UNION SELECT m.topic, m.message, m.message_id, m.refs FROM messages m JOIN message_refs r "
+                "ON m.topic = r.topic AND m.message = r.message WHERE r.ref = ?", (i, i)).fetchall()
+            rows += self.db.execute("SELECT topic, message, message_id, refs FROM messages WHERE topic IN "
+                "(SELECT topic FROM messages WHERE message_id = ?)", (i,)).fetchall()
+            for topic, message, mid, refs in rows:
+                found.add( (topic, message) )
+                for j in [mid] + (refs or "").split():
+                    if j and not j in ids:
+                        ids.add(j)
+                        todo.append(j)
+        result = []
+        for topic, message in found:
+            result.extend( self.db.execute("SELECT %s FROM messages WHERE topic = ? AND message = ?" % self.COLUMNS, (topic, message)) )
+        return sorted(result, key=lambda r: (r[2], r[0], r[1]))
+
+    def search(self, sender=None, subject=None, since=None, until=None):
+        conditions, params = [], []
+        if sender:
+            conditions.append("sender LIKE ?")
+            params.append("%%%s%%" % sender)
+        if subject:
+            conditions.append("subject LIKE ?")
+            params.append("%%%s%%" % subject)
+        if since is not None:
+            conditions.append("date >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("date < ?")
+            params.append(until)
+        return self.db.execute("SELECT %s FROM messages%s ORDER BY date, topic, message" % (self.COLUMNS,
+            " WHERE " + " AND ".join(conditions) if conditions else ""), params).fetchall()
+
+def _text(value):
+    return value.decode("utf-8", "replace")
+
+def _day(value):
+    return calendar.timegm(time.strptime(value, "%Y-%m-%d"))
+
+def main(argv=None):
+    parser = ArgumentParser(prog="gggd index", description="Update the index of the messages retrieved for a group (GROUP.index) and query it")
+    parser.add_argument("-v", "--verbose", action="store_true", help="List the messages that are indexed")
+    parser.add_argument("-f", "--format", choices=sorted(STORES.keys()), help="Storage format of the group directory [default: detected]")
+    parser.add_argument("-n", "--no-update", action="store_true", help="Only query, don't update the index first")
+    parser.add_argument("--id", help="Show the message with this Message-ID")
+    parser.add_argument("--thread", metavar="ID", help="Show all messages of the thread of the message with this Message-ID")
+    parser.add_argument("--from", dest="sender", type=_text, help="Show the messages with a From header containing this text")
+    parser.add_argument("--subject", type=_text, help="Show the messages with a Subject containing this text")
+    parser.add_argument("--since", type=_day, metavar="YYYY-MM-DD", help="Show the messages from this day on")
+    parser.add_argument("--until", type=_day, metavar="YYYY-MM-DD", help="Show the messages before this day")
+    parser.add_argument(dest="group", help="Name of the group (directory)", metavar="group")
+    args = parser.parse_args(argv)
+
+    index = MessageIndex("%s.index" % args.group)
+    if not args.no_update:
+        store = STORES[args.format or detect_format(args.group)](args.group)
+        manifest = ArchiveManifest("%s.manifest" % args.group)
+        if not manifest.exists():
+            manifest.rebuild(store)
+        changed, removed = index.update(manifest, store, args.verbose)
+        if args.verbose: print "%i messages indexed, %i removed" % (changed, removed)
+
+    if args.id:
+        rows = index.find_id(args.id)
+    elif args.thread:
+        rows = index.thread(args.thread)
+    elif args.sender or args.subject or args.since is not None or args.until is not None:
+        rows = index.search(args.sender, args.subject, args.since, args.until)
+    else:
+        return 0
+
+    for topic, message, date, sender, subject, message_id in rows:
+        print (u"%s\t%s\t%s\t%s\t%s" % (os.path.join(args.group, topic, message),
+            time.strftime("%Y-%m-%d %H:%M", time.gmtime(date)) if date is not None else "-",
+            sender or "", subject or "", message_id or "")).encode("utf-8")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,198 @@
+'''
+Statistics of a gggd run: latency histograms, bytes received and status codes of
+the requests of each kind, retries, and the time spent in parsing, demangling and
+writing. Written with --stats as JSON, or in the Prometheus text format.
+
+@author: henryk
+'''
+import time
+import json
+import bisect
+import threading
+from contextlib import contextmanager
+
+from archive import atomic_write
+
+class Histogram(object):
+    '''Count and sum of observed durations, with the number of them up to each bucket bound'''
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def cumulative(self):
+        '''(upper bound, number of observations up to it), the last bound is "+Inf"'''
+        total = 0
+        result = []
+        for bound, count in zip(self.BUCKETS + ("+Inf",), self.counts):
+            total += count
+            result.append( (bound, total) )
+        return result
+
+    def as_dict(self):
+        return {"count": self.count, "seconds": self.sum,
+            "buckets": [ [bound, count] for bound, count in self.cumulative() ]}
+
+class RequestStatistics(object):
+    '''Statistics of the requests of one kind (see GroupInformation.URL_KINDS)'''
+    def __init__(self):
+        self.latency = Histogram()
+        self.bytes = 0
+        self.status = {}
+        self.retries = 0
+
+    def as_dict(self):
+        return {"latency": self.latency.as_dict(), "bytes": self.bytes,
+            "status": dict( (str(code), count) for code, count in self.status.iteritems() ), "retries": self.retries}
+
+class GroupStatistics(object):
+    '''Statistics of one group, updated from all threads working on it'''
+    def __init__(self, lock):
+        self.lock = lock
+        self.requests = {}
+        self.timers = {}
+        self.messages_written = 0
+        self.bytes_written = 0
+
+    def request(self, kind, seconds, status, size=0):
+        '''A request of kind took seconds and was answered with status (a HTTP status
+        code, or "error" for a network error) and size bytes'''
+        with self.lock:
+            stats = self.requests.get(kind)
+            if stats is None:
+                stats = self.requests[kind] = RequestStatistics()
+            stats.latency.add(seconds)
+            stats.bytes += size
+            stats.status[status] = stats.status.get(status, 0) + 1
+
+    def retry(self, kind):
+        with self.lock:
+            stats = self.requests.get(kind)
+            if stats is None:
+                stats = self.requests[kind] = RequestStatistics()
+            stats.retries += 1
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = Histogram()
+            timer.add(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        '''Add the time spent in the with block to the timer name'''
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - started)
+
+    def written(self, size):
+        with self.lock:
+            self.messages_written += 1
+            self.bytes_written += size
+
+    def as_dict(self):
+        return {"requests": dict( (kind, stats.as_dict()) for kind, stats in self.requests.iteritems() ),
+            "timers": dict( (name, timer.as_dict()) for name, timer in self.timers.iteritems() ),
+            "messages_written": self.messages_written, "bytes_written": self.bytes_written}
+
+def _labels(**labels):
+    return "{%s}" % ",".join( '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in sorted(labels.items()) )
+
+def _histogram(lines, name, histogram, **labels):
+    for bound, count in histogram.cumulative():
+        lines.append("%s_bucket%s %i" % (name, _labels(le=bound, **labels), count))
+    lines.append("%s_sum%s %f" % (name, _labels(**labels), histogram.sum))
+    lines.append("%s_count%s %i" % (name, _labels(**labels), histogram.count))
+
+class RunStatistics(object):
+    '''Statistics of all groups of a run. If file_name is given, save() writes them to
+    it, in file_format "json" or "prometheus".'''
+    FORMATS = ("json", "prometheus")
+
+    def __init__(self, file_name=None, file_format="json"):
+        self.file_name = file_name
+        self.file_format = file_format
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.groups = {}
+
+    def group(self, name):
+        with self.lock:
+            if not name in self.groups:
+                self.groups[name] = GroupStatistics(self.lock)
+            return self.groups[name]
+
+    def as_dict(self):
+        with self.lock:
+            return {"started": self.started, "seconds": time.time() - self.started,
+                "groups": dict( (name, group.as_dict()) for name, group in self.groups.iteritems() )}
+
+    def prometheus(self):
+        '''The statistics in the Prometheus text exposition format'''
+        lines = []
+        with self.lock:
+            groups = sorted(self.groups.items())
+            lines.extend(["# HELP gggd_run_seconds Time since the start of the run",
+                "# TYPE gggd_run_seconds gauge",
+                "gggd_run_seconds %f" % (time.time() - self.started)])
+
+            lines.extend(["# HELP gggd_request_duration_seconds Duration of requests, by kind of page",
+                "# TYPE gggd_request_duration_seconds histogram"])
+            for group, stats in groups:
+                for kind, requests in sorted(stats.requests.items()):
+                    _histogram(lines, "gggd_request_duration_seconds", requests.latency, group=group, kind=kind)
+
+            lines.extend(["# HELP gggd_response_bytes_total Bytes received, by kind of page",
+                "# TYPE gggd_response_bytes_total counter"])
+            for group, stats in groups:
+                for kind, requests in sorted(stats.requests.items()):
+                    lines.append("gggd_response_bytes_total%s %i" % (_labels(group=group, kind=kind), requests.bytes))
+
+            lines.extend(["# HELP gggd_responses_total Responses, by kind of page and status code",
+                "# TYPE gggd_responses_total counter"])
+            for group, stats in groups:
+                for kind, requests in sorted(stats.requests.items()):
+                    for code, count in sorted(requests.status.items()):
+                        lines.append("gggd_responses_total%s %i" % (_labels(group=group, kind=kind, code=code), count))
+
+            lines.extend(["# HELP gggd_retries_total Repeated requests, by kind of page",
+                "# TYPE gggd_retries_total counter"])
+            for group, stats in groups:
+                for kind, requests in sorted(stats.requests.items()):
+                    lines.append("gggd_retries_total%s %i" % (_labels(group=group, kind=kind), requests.retries))
+
+            lines.extend(["# HELP gggd_step_duration_seconds Time spent in parsing, demangling and writing",
+                "# TYPE gggd_step_duration_seconds histogram"])
+            for group, stats in groups:
+                for name, timer in sorted(stats.timers.items()):
+                    _histogram(lines, "gggd_step_duration_seconds", timer, group=group, step=name)
+
+            lines.extend(["# HELP gggd_messages_written_total Messages written",
+                "# TYPE gggd_messages_written_total counter"])
+            for group, stats in groups:
+                lines.append("gggd_messages_written_total%s %i" % (_labels(group=group), stats.messages_written))
+            lines.extend(["# HELP gggd_written_bytes_total Bytes of messages written",
+                "# TYPE gggd_written_bytes_total counter"])
+            for group, stats in groups:
+                lines.append("gggd_written_bytes_total%s %i" % (_labels(group=group), stats.bytes_written))
+        return "".join(l + "\n" for l in lines)
+
+    def save(self):
+        if not self.file_name:
+            return
+        if self.file_format == "prometheus":
+            data = self.prometheus()
+        else:
+            data = json.dumps(self.as_dict(), indent=2, sort_keys=True) + "\n"
+        atomic_write(self.file_name, data)
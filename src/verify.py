@@ -0,0 +1,179 @@
+#!/usr/bin/env python2.7
+'''
+gggd verify -- check the retrieved messages of a group against GROUP.manifest
+
+Each message is compared with the size and SHA-1 checksum the manifest recorded when
+it was retrieved, and must start with a header. Messages are checked in parallel
+processes, large files are mapped instead of read.
+
+@author: henryk
+'''
+from argparse import ArgumentParser
+import sys
+import os
+import re
+import errno
+import mmap
+import hashlib
+import multiprocessing
+
+from archive import ArchiveManifest, TreeStore, STORES, detect_format
+
+# A header field name and colon, at the start of the message
+_HEADER_FIELD = re.compile(r"[!-9;-~]+:")
+
+def _size_problem(actual_size, size):
+    if actual_size == 0:
+        return "empty"
+    if actual_size < size:
+        return "truncated"
+    if actual_size != size:
+        return "size"
+    return None
+
+def check_data(data, size, sha1):
+    '''The problem with a message (a string or mmap object) whose manifest entry has
+    size and sha1, or None'''
+    problem = _size_problem(len(data), size)
+    if problem:
+        return problem
+    if not _HEADER_FIELD.match(data[:1000]) or (data.find("\r\n\r\n") < 0 and data.find("\n\n") < 0):
+        return "no header"
+    if hashlib.sha1(data).hexdigest() != sha1:
+        return "checksum"
+    return None
+
+# Smaller files are read, mapping them takes longer
+MAP_SIZE = 256*1024
+
+def check_file(file_name, size, sha1):
+    '''check_data for a file, which is mapped instead of read if it is large'''
+    try:
+        with open(file_name, "rb") as fp:
+            # A wrong size is found without reading the file
+            problem = _size_problem(os.fstat(fp.fileno()).st_size, size)
+            if problem:
+                return problem
+            if size < MAP_SIZE:
+                return check_data(fp.read(), size, sha1)
+            buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return check_data(buf, size, sha1)
+            finally:
+                buf.close()
+    except (IOError, OSError) as e:
+        return "missing" if e.errno == errno.ENOENT else "unreadable"
+
+_store = None
+
+def _init_worker(store_format, group):
+    global _store
+    _store = STORES[store_format](group)
+
+def _check_job(job):
+    '''Check one message in a pool worker, returns (topic, message, problem or None)'''
+    topic, message, (size, sha1, fetch_time, location) = job
+    if isinstance(_store, TreeStore):
+        return topic, message, check_file(_store.describe(topic, message, location), size, sha1)
+    try:
+        data = _store.read(topic, message, location)
+    except Exception:
+        # Missing file, or a corrupted or cut off segment
+        return topic, message, "unreadable"
+    return topic, message, check_data(data, size, sha1)
+
+def unlisted_files(store, manifest):
+    '''Files in a tree store that aren't in the manifest, as (topic, message). Files
+    named after a message with a suffix, like the .demangled files demangle.py writes,
+    belong to that message.'''
+    if not os.path.isdir(store.group_dir):
+        return
+    for topic in sorted(os.listdir(store.group_dir)):
+        if topic.startswith(".") or not os.path.isdir(os.path.join(store.group_dir, topic)):
+            continue
+        for message in sorted(os.listdir(os.path.join(store.group_dir, topic))):
+            if not message.startswith(".") and not manifest.contains(topic, message) \
+                    and not manifest.contains(topic, message.split(".", 1)[0]):
+                yield topic, message
+
+def verify(store_format, group, manifest, jobs=1):
+    '''Yields (topic, message, problem) for all messages in manifest with a problem,
+    in no particular order'''
+    _init_worker(store_format, group)
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, _init_worker, (store_format, group))
+        try:
+            for result in pool.imap_unordered(_check_job, manifest.entries(), chunksize=256):
+                if result[2]:
+                    yield result
+        finally:
+            pool.terminate()
+    else:
+        for job in manifest.entries():
+            result = _check_job(job)
+            if result[2]:
+                yield result
+
+# Problems of messages that are there, but differ from what was retrieved. demangle.py -i
+# changes messages as well, retrieving them again would undo that.
+CHANGED = ("truncated", "size", "checksum")
+
+def requeue(group, organization, base_url, manifest, messages):
+    '''Drop messages from the manifest and add them to the messages to retry (GROUP.failed),
+    so that gggd --retry-failed retrieves them again'''
+    # gggd imports this module
+    import gggd
+    base_url = (base_url or gggd.BASE_URL).rstrip("/") + ("/a/%s" % organization if organization else "")
+    dead_letters = gggd.DeadLetters("%s.failed" % group)
+    for topic, message in messages:
+        dead_letters.add("%s/forum/message/raw?msg=%s/%s/%s" % (base_url, group, topic, message))
+    dead_letters.close()
+    manifest.remove(messages)
+
+def main(argv=None):
+    parser = ArgumentParser(prog="gggd verify", description="Check the messages retrieved for a group against the sizes and checksums in GROUP.manifest, "
+        "and list the ones that are missing, empty, truncated, changed or without header")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Report the number of messages checked")
+    parser.add_argument("-f", "--format", choices=sorted(STORES.keys()), help="Storage format of the group directory [default: detected]")
+    parser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(), help="Number of processes to check with [default: %(default)s]")
+    parser.add_argument("-r", "--requeue", action="store_true", help="Remove the missing, empty, unreadable messages and those without header from the manifest "
+        "and add them to GROUP.failed, to retrieve them again with gggd --retry-failed")
+    parser.add_argument("-R", "--requeue-changed", action="store_true", help="Like -r, and also requeue truncated and changed messages. "
+        "Messages demangled with demangle.py -i are changed as well, retrieving them again undoes the demangling.")
+    parser.add_argument("-o", "--organization", help="Organization of the group, for the URLs in GROUP.failed")
+    parser.add_argument("--base-url", help="Address of Google Groups, for the URLs in GROUP.failed [default: https://groups.google.com]")
+    parser.add_argument(dest="group", help="Name of the group (directory)", metavar="group")
+    args = parser.parse_args(argv)
+
+    manifest = ArchiveManifest("%s.manifest" % args.group)
+    if not manifest.exists():
+        print >>sys.stderr, "%s.manifest not found, nothing to check against" % args.group
+        return 2
+    store_format = args.format or detect_format(args.group)
+    store = STORES[store_format](args.group)
+
+    bad = []
+    for topic, message, problem in verify(store_format, args.group, manifest, args.jobs):
+        print "%s\t%s" % (store.describe(topic, message, manifest.get(topic, message)[3]), problem)
+        bad.append( (topic, message, problem) )
+    unlisted = 0
+    if isinstance(store, TreeStore):
+        for topic, message in unlisted_files(store, manifest):
+            print "%s\tnot in manifest" % store.describe(topic, message)
+            unlisted += 1
+    if args.verbose:
+        print >>sys.stderr, "%i messages checked, %i bad, %i files not in the manifest" % (
+            sum(len(m) for m in manifest.topics.itervalues()), len(bad), unlisted)
+
+    if args.requeue or args.requeue_changed:
+        messages = [ (topic, message) for topic, message, problem in bad if args.requeue_changed or not problem in CHANGED ]
+        if messages:
+            requeue(args.group, args.organization, args.base_url, manifest, messages)
+            if args.verbose: print >>sys.stderr, "%i messages added to %s.failed" % (len(messages), args.group)
+        if len(messages) < len(bad):
+            print >>sys.stderr, "%i messages differ from what was retrieved and were not requeued, e.g. because they were demangled with demangle.py -i. " \
+                "Use -R to retrieve them again." % (len(bad) - len(messages))
+    return 1 if bad or unlisted else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,134 @@
+'''
+Work queue of a crawl shared by several processes, possibly on several hosts: the
+topics found by the coordinator, which workers claim with a lease. Kept in an SQLite
+database next to the group directory, GROUP.queue.
+
+@author: henryk
+'''
+import os
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS topics (
+    topic TEXT PRIMARY KEY,
+    priority INTEGER NOT NULL,
+    last_post TEXT,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    claims INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS topics_state ON topics (state, priority);
+"""
+
+class TopicQueue(object):
+    '''Topics of a crawl in the states pending, leased (claimed by a worker until the
+    lease runs out), done and failed (given up after MAX_CLAIMS claims). A leased topic
+    whose lease ran out can be claimed by another worker.
+
+    Usable from several threads, each gets its own connection.'''
+    MAX_CLAIMS = 3
+    TIMEOUT = 60
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.local = threading.local()
+        self.db.executescript(SCHEMA)
+
+    @property
+    def db(self):
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.file_name, timeout=self.TIMEOUT, isolation_level=None)
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        '''Write transaction, taking the database lock right away'''
+        db = self.db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def get(self, name):
+        row = self.db.execute("SELECT value FROM settings WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, name, value):
+        with self._transaction() as db:
+            db.execute("INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)", (name, value))
+
+    def add(self, topics):
+        '''Add (topic, last post date) pairs, after the topics already there. Topics
+        that are already in the queue are left alone.'''
+        with self._transaction() as db:
+            priority = db.execute("SELECT COALESCE(MAX(priority), -1) + 1 FROM topics").fetchone()[0]
+            for topic, last_post in topics:
+                if db.execute("INSERT OR IGNORE INTO topics (topic, priority, last_post) VALUES (?, ?, ?)",
+                        (topic, priority, last_post)).rowcount:
+                    priority += 1
+
+    def claim(self, worker, lease_time):
+        '''The first pending topic, or one with an expired lease, leased to worker for
+        lease_time seconds. Returns (topic, last post date, number of claims so far) or None.
+        Expired leases of topics claimed MAX_CLAIMS times already are given up.'''
+        now = time.time()
+        with self._transaction() as db:
+            # Their workers died, probably because of the topic
+            db.execute("UPDATE topics SET state = 'failed', worker = NULL, lease_until = NULL "
+                "WHERE state = 'leased' AND lease_until < ? AND claims >= ?", (now, self.MAX_CLAIMS))
+            row = db.execute("SELECT topic, last_post, claims FROM topics WHERE state = 'pending' "
+                "OR (state = 'leased' AND lease_until < ?) ORDER BY priority LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE topics SET state = 'leased', worker = ?, lease_until = ?, claims = claims + 1 WHERE topic = ?",
+                (worker, now + lease_time, row[0]))
+        return row[0], row[1], row[2] + 1
+
+    def renew(self, worker, topics, lease_time):
+        '''Extend the leases of worker on topics'''
+        if not topics:
+            return
+        with self._transaction() as db:
+            db.executemany("UPDATE topics SET lease_until = ? WHERE topic = ? AND worker = ? AND state = 'leased'",
+                [ (time.time() + lease_time, topic, worker) for topic in topics ])
+
+    def done(self, worker, topic):
+        '''worker has finished topic, unless its lease ran out and another worker claimed it'''
+        with self._transaction() as db:
+            db.execute("UPDATE topics SET state = 'done', worker = NULL, lease_until = NULL "
+                "WHERE topic = ? AND worker = ? AND state = 'leased'", (topic, worker))
+
+    def release(self, worker, topic):
+        '''worker couldn't finish topic: let another worker try, unless it has been claimed
+        MAX_CLAIMS times already'''
+        with self._transaction() as db:
+            db.execute("UPDATE topics SET state = CASE WHEN claims >= ? THEN 'failed' ELSE 'pending' END, "
+                "worker = NULL, lease_until = NULL WHERE topic = ? AND worker = ? AND state = 'leased'",
+                (self.MAX_CLAIMS, topic, worker))
+
+    def counts(self):
+        '''Number of topics in each state'''
+        return dict(self.db.execute("SELECT state, COUNT(*) FROM topics GROUP BY state").fetchall())
+
+    def finished(self):
+        '''All topics have been found, and none is pending or leased'''
+        counts = self.counts()
+        return self.get("discovery") == "done" and not counts.get("pending") and not counts.get("leased")
+
+    def remove(self):
+        '''The crawl is complete, the next one should start with an empty queue'''
+        self.db.close()
+        self.local.db = None
+        os.unlink(self.file_name)